@@ -1,22 +1,52 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_from_directory, \
-    send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_file, \
+    Response, g, has_request_context, make_response
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge, NotFound
+from werkzeug.middleware.proxy_fix import ProxyFix
+from flask.sessions import SecureCookieSessionInterface
 from datetime import datetime, timezone, timedelta
 from flask_wtf.csrf import CSRFProtect
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+import atexit
 import os
 import base64
 import hashlib
-import zipfile
+import hmac
+import html
 import shutil
 import json
+import math
+import mimetypes
 import glob
 from flask_migrate import Migrate
+import click
 import magic
 import logging
-from io import BytesIO
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import wraps
+from urllib.parse import quote
+from sqlalchemy import create_engine, text, event, DDL, tuple_, func, case, bindparam
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from utils.upload_assembly import ChunkAssembly
+from utils.file_utils import stream_to_file, read_header
+from utils.thumbnails import render_thumbnails
+from utils.zip_stream import stream_zip
+from utils.ttl_cache import TTLCache
+from utils.admission import BoundedExecutor, ExecutorBusy, RateLimiter
+from utils.view_counter import CounterBuffer
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -32,15 +62,151 @@ app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=2)
 app.config['SESSION_PERMANENT'] = True
 app.config['SESSION_TYPE'] = 'filesystem'
 app.config['MAX_CONTENT_LENGTH'] = 200 * 1024 * 1024  # 200MB
+app.config['MAX_UPLOAD_SIZE'] = 20 * 1024 * 1024 * 1024  # 20GB, 分片上传的总大小上限
+app.config['UPLOAD_CHUNK_SIZE'] = 5 * 1024 * 1024  # 由服务器下发给客户端的分片大小
+app.config['UPLOAD_MAX_CONCURRENCY'] = 4  # 客户端同时上传的分片数上限
+app.config['UPLOAD_SESSION_TTL'] = timedelta(hours=24)  # 超过该时间无新分片的上传会话会被回收
+app.config['UPLOAD_REAPER_INTERVAL'] = 600  # seconds
+app.config['UPLOAD_ASSEMBLY_CACHE_SIZE'] = 1000  # 每个进程缓存的上传会话数，淘汰后从数据库重建
+app.config['SHARE_DEFAULT_DAYS'] = 7  # 分享链接默认有效天数
+app.config['SHARE_MAX_DAYS'] = 365
+# 分享链接在每个进程缓存的时间（秒）；撤销和删除在本进程立即生效，其他进程最多延迟这么久
+app.config['SHARE_CACHE_TTL'] = 30
+app.config['SHARE_CACHE_SIZE'] = 10000
+app.config['SHARED_PAGE_CACHE_TTL'] = 300  # 秒，渲染好的分享页在进程内缓存的时间，不超过分享的有效期
+app.config['SHARED_PAGE_CACHE_SIZE'] = 1000
+app.config['SHARED_PAGE_MAX_AGE'] = 60  # 秒，允许 CDN/代理缓存分享页和分享文件的时间；撤销后最多延迟这么久才失效
+app.config['SHARE_VIEW_FLUSH_INTERVAL'] = 10  # 秒，访问计数在内存中累积，按该间隔批量写入
+# 超过保留期的笔记由后台分批删除；None 为永久保留。用户的 retention_days（如会员 365 天）优先于该默认值
+app.config['NOTE_RETENTION_DAYS'] = None
+app.config['RETENTION_BATCH'] = 200  # 每个事务删除的笔记数
+app.config['RETENTION_BATCHES_PER_RUN'] = 50
+app.config['RETENTION_THROTTLE'] = 1.0  # 每批之后暂停该批耗时的 1 倍
+# 存储回收：清理没有笔记引用的文件；新文件在宽限期内不动，给进行中的上传和画廊组装留出时间
+app.config['STORAGE_GC_GRACE'] = timedelta(hours=24)
+app.config['STORAGE_GC_STEPS_PER_RUN'] = 16  # 每次回收检查的分片目录数，256 个 blob 分片 + 旧文件共 257 步为一轮
+app.config['STORAGE_GC_BATCH'] = 500
+app.config['STORAGE_GC_THROTTLE'] = 1.0  # 每步之后暂停该步耗时的 1 倍
+app.config['JOB_WORKERS'] = 2  # 后台处理上传文件的线程数
+app.config['JOB_POLL_INTERVAL'] = 5  # seconds, 兜底轮询（其他进程入队或重启后遗留的任务）
+app.config['JOB_MAX_ATTEMPTS'] = 3
+app.config['JOB_TIMEOUT'] = timedelta(minutes=30)  # running 超过该时间视为进程已退出，重新排队
+app.config['JOB_RETENTION'] = timedelta(days=1)  # 已结束任务的保留时间，供客户端轮询结果
+app.config['BULK_MAX_NOTES'] = 5000  # 单次批量操作最多处理的笔记数，超出的部分由客户端再次提交
+app.config['GALLERY_PAGE_SIZE'] = 20  # 画廊页每次加载的图片数
+app.config['THUMBNAIL_SIZES'] = {'sm': 320, 'md': 640}  # 最长边像素；页面最大显示 300px，对应 1x / 2x 屏
+app.config['THUMBNAIL_FORMAT'] = 'webp'
+app.config['THUMBNAIL_QUALITY'] = 80
+app.config['IMMUTABLE_FILE_MAX_AGE'] = 365 * 24 * 3600  # 以内容哈希命名的文件（blob、缩略图）可长期缓存
+# 文件下载交给前端代理发送：None（由 Flask 发送）/ 'x-accel-redirect'（nginx）/ 'x-sendfile'（Apache、lighttpd）
+# nginx 示例: location /_protected_uploads/ { internal; alias /path/to/Uploads/; }
+app.config['FILE_OFFLOAD'] = None
+app.config['X_ACCEL_REDIRECT_PREFIX'] = '/_protected_uploads/'
+# 前面有几层反向代理：>0 时从 X-Forwarded-For / X-Forwarded-Proto 取客户端地址和协议（按 IP 限流依赖它）。
+# 没有代理时必须为 0，否则客户端可以伪造 X-Forwarded-For
+app.config['TRUSTED_PROXY_HOPS'] = 0
+# 每个用户的存储上限（字节），None 表示不限制
+app.config['USER_STORAGE_QUOTA'] = None
+# 用量计数器定期按 note 表重算一次，修正漂移
+app.config['USAGE_RECONCILE_INTERVAL'] = timedelta(hours=6)
+app.config['USAGE_RECONCILE_BATCH'] = 200
+# SQLite 连接配置：WAL 让读不再等待写入提交，busy_timeout 让并发写入排队而不是报 "database is locked"
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # WAL 下断电最多丢失最后几次提交，不会损坏数据库
+    'cache_size': -64000,  # 负数单位为 KiB，约 64MB
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    # SQLite 默认不检查外键；打开后 ondelete='CASCADE'（note_item、note_share、upload_chunk）才会生效
+    'foreign_keys': 'ON',
+}
+app.config['SQLITE_BUSY_TIMEOUT'] = 15  # 秒
+# 只读视图走单独的连接池（连接设置 query_only），不和上传提交抢写连接；False 时全部走主连接
+app.config['SQLITE_READ_ENGINE'] = True
+app.config['SQLITE_READ_POOL_SIZE'] = 10
+# 每个进程缓存已登录用户，缩略图、文件等请求不再每次查询 user 表；用户信息变更时立即失效
+app.config['USER_CACHE_TTL'] = 60  # 秒
+app.config['USER_CACHE_SIZE'] = 10000
+# 密码哈希（PBKDF2）放在独立的有界线程池里，登录风暴时直接拒绝而不是占满所有请求线程
+app.config['PASSWORD_HASH_WORKERS'] = 2
+app.config['PASSWORD_HASH_QUEUE'] = 16
+app.config['PASSWORD_HASH_TIMEOUT'] = 10  # 秒
+# 登录/注册准入：每个 IP、每个用户名的尝试次数 (次数, 秒)
+app.config['AUTH_RATE_LIMIT_ENABLED'] = True
+app.config['AUTH_IP_RATE'] = (30, 60)
+app.config['AUTH_USERNAME_RATE'] = (10, 60)
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['TEMP_CHUNK_DIR'], exist_ok=True)
-
-db = SQLAlchemy(app)
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXY_HOPS'],
+                        x_proto=app.config['TRUSTED_PROXY_HOPS'])
+
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Applied to every new SQLite connection of every engine, including the read engine."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    # 先设置等待时间，切换 WAL 时如果有别的连接在写也会等待
+    cursor.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT'] * 1000)}")
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+
+read_engine = None
+read_engine_lock = threading.Lock()
+
+
+def get_read_engine():
+    """Pooled, query_only engine on the same database file; None when disabled or the database is in memory."""
+    global read_engine
+    if not app.config['SQLITE_READ_ENGINE']:
+        return None
+    with read_engine_lock:
+        if read_engine is None:
+            url = db.engine.url
+            if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+                return None
+            read_engine = create_engine(url, pool_size=app.config['SQLITE_READ_POOL_SIZE'], max_overflow=0,
+                                        pool_timeout=app.config['SQLITE_BUSY_TIMEOUT'])
+            event.listen(read_engine, 'connect',
+                         lambda dbapi_connection, connection_record: dbapi_connection.execute('PRAGMA query_only = ON'))
+        return read_engine
+
+
+class ReadRoutingSession(FlaskSQLAlchemySession):
+    """Sends the queries of @read_only_db views to the read engine; flushes always use the primary engine."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context() and g.get('read_only_db'):
+            engine = get_read_engine()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_only_db(view):
+    """Run a view's queries on the read engine. The view must not write: read connections are query_only."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only_db = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+db = SQLAlchemy(app, session_options={'class_': ReadRoutingSession})
 migrate = Migrate(app, db)
 csrf = CSRFProtect(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
+# UploadSession.id -> (会话创建时间, ChunkAssembly)，缓存每个上传会话的滚动MD5。
+# 多进程部署时别的进程可能已删除并用同一 id 重建会话，创建时间不符的缓存作废；闲置超过会话有效期的自动过期
+upload_sessions = TTLCache(ttl=app.config['UPLOAD_SESSION_TTL'].total_seconds(),
+                           maxsize=app.config['UPLOAD_ASSEMBLY_CACHE_SIZE'])
+upload_sessions_lock = threading.Lock()
+
 
 # Template filter for JSON parsing
 @app.template_filter('fromjson')
@@ -65,11 +231,22 @@ ALLOWED_EXTENSIONS = {
     '.exe', '.msi', '.apk', '.dmg', '.iso'
 }
 
+# 内容寻址存储目录（相对 UPLOAD_FOLDER），文件按 MD5 前两位分桶
+BLOB_SUBDIR = 'blobs'
+
+# 秒传时客户端需要证明持有文件：对服务器指定的这段字节计算MD5
+INSTANT_UPLOAD_PROOF_SIZE = 64 * 1024
+INSTANT_UPLOAD_CHALLENGE_TTL = 300  # 挑战令牌有效期（秒）
+
+# 可以生成缩略图的原图类型
+THUMBNAIL_SOURCE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif'}
+
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False, index=True)
     password_hash = db.Column(db.String(128), nullable=False)
+    retention_days = db.Column(db.Integer, nullable=True)  # 笔记保留天数；None 表示使用 NOTE_RETENTION_DAYS
     notes = db.relationship('Note', backref='user', lazy=True)
 
 
@@ -82,12 +259,114 @@ class Note(db.Model):
     additional_text = db.Column(db.Text, nullable=True)
     timestamp = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc), index=True)
     file_size = db.Column(db.Integer, nullable=True)
-    md5 = db.Column(db.String(32), nullable=True)
+    md5 = db.Column(db.String(32), nullable=True, index=True)
+    status = db.Column(db.String(20), nullable=False, default='ready', server_default='ready')  # pending/ready
+    item_count = db.Column(db.Integer, nullable=True)  # gallery/zip 成员数；None 表示成员仍以 JSON 存在 content_data
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # 内容每次变化加一，见 bump_note_version
+    items = db.relationship('NoteItem', lazy='dynamic', order_by='NoteItem.ordinal', passive_deletes='all')
+    # MD5 前缀搜索在每个用户内做范围扫描；列表按 (timestamp, id) 游标分页
+    __table_args__ = (db.Index('ix_note_user_md5', 'user_id', 'md5'),
+                      db.Index('ix_note_user_timestamp', 'user_id', db.desc('timestamp'), db.desc('id')))
 
     def __repr__(self):
         return f'<Note {self.id} {self.content_type}>'
 
 
+class NoteItem(db.Model):
+    """One member file of a gallery or zip note, in display order."""
+    id = db.Column(db.Integer, primary_key=True)
+    note_id = db.Column(db.Integer, db.ForeignKey('note.id', ondelete='CASCADE'), nullable=False)
+    ordinal = db.Column(db.Integer, nullable=False)
+    path = db.Column(db.String(255), nullable=False)  # relative to UPLOAD_FOLDER
+    filename = db.Column(db.Text, nullable=True)  # 原始文件名
+    file_size = db.Column(db.BigInteger, nullable=True)
+    md5 = db.Column(db.String(32), nullable=True, index=True)
+    __table_args__ = (db.UniqueConstraint('note_id', 'ordinal', name='uq_note_item_ordinal'),)
+
+
+class UserUsage(db.Model):
+    """Per-user note count and SUM(note.file_size), updated in the same transaction as the notes."""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    note_count = db.Column(db.Integer, nullable=False, default=0)
+    storage_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    reconciled_at = db.Column(db.DateTime, nullable=True)
+
+
+class Blob(db.Model):
+    """Content-addressed file shared by every note holding the same bytes; removed when ref_count drops to 0."""
+    md5 = db.Column(db.String(32), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    path = db.Column(db.String(255), nullable=False, unique=True)  # relative to UPLOAD_FOLDER
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    # 最近一次存入或交给客户端的时间；无引用的 blob 从这时起计算回收宽限期
+    last_seen = db.Column(db.DateTime, nullable=True, default=lambda: datetime.now(timezone.utc))
+
+
+class UploadSession(db.Model):
+    """A resumable chunked upload; the bytes live in TEMP_CHUNK_DIR/<id>.part until finalized."""
+    id = db.Column(db.String(160), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    file_size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    total_chunks = db.Column(db.Integer, nullable=False)
+    bytes_received = db.Column(db.BigInteger, nullable=False, default=0)
+    status = db.Column(db.String(20), nullable=False, default='uploading')  # uploading/finalizing
+    mode = db.Column(db.String(20), nullable=False, default='file')
+    additional_text = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    updated_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc), index=True)
+    chunks = db.relationship('UploadChunk', backref='session', lazy=True, cascade='all, delete-orphan')
+
+    @property
+    def part_path(self):
+        return os.path.join(app.config['TEMP_CHUNK_DIR'], f'{self.id}.part')
+
+
+class UploadChunk(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(160), db.ForeignKey('upload_session.id', ondelete='CASCADE'), nullable=False,
+                           index=True)
+    chunk_index = db.Column(db.Integer, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.UniqueConstraint('session_id', 'chunk_index', name='uq_upload_chunk_index'),)
+
+
+class Job(db.Model):
+    """Work deferred off the request thread. The table is the queue; workers claim rows with a conditional update."""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(40), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)  # pending/running/done/failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    result = db.Column(db.Text, nullable=True)  # JSON
+    error = db.Column(db.Text, nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    note_id = db.Column(db.Integer, nullable=True)  # 任务处理中笔记可能被删除，不加外键
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    updated_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+
+class NoteShare(db.Model):
+    """A public link to one note; anonymous views look it up by share_token through its unique index."""
+    id = db.Column(db.Integer, primary_key=True)
+    note_id = db.Column(db.Integer, db.ForeignKey('note.id', ondelete='CASCADE'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    share_token = db.Column(db.String(64), unique=True, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    expires_at = db.Column(db.DateTime, nullable=False)
+    access_count = db.Column(db.Integer, nullable=False, default=0)  # 内存中尚未写入的访问见 share_views
+    is_active = db.Column(db.Boolean, nullable=False, default=True)
+
+
+class WorkerCheckpoint(db.Model):
+    """Where a long-running background sweep stopped, so it resumes there after a restart."""
+    name = db.Column(db.String(60), primary_key=True)
+    value = db.Column(db.Text, nullable=False)  # JSON
+    updated_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+
 # FIX 1: 简化文件验证逻辑，使其更加宽容
 def allowed_file(filename, file_content=None):
     """
@@ -122,9 +401,63 @@ def allowed_file(filename, file_content=None):
     return True
 
 
+user_cache = TTLCache(app.config['USER_CACHE_TTL'], app.config['USER_CACHE_SIZE'])
+
+
+def detached_user_copy(user):
+    """A session-independent copy of a user's columns, safe to share between requests and threads."""
+    copy = User(**{attr.key: getattr(user, attr.key) for attr in db.inspect(User).column_attrs})
+    make_transient_to_detached(copy)
+    return copy
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    user_id = int(user_id)
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        # load=False 把缓存的副本放进当前会话而不查询数据库
+        return db.session.merge(cached, load=False)
+    user = db.session.get(User, user_id)
+    if user is not None:
+        user_cache.set(user_id, detached_user_copy(user))
+    return user
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, user):
+    """Any change to a user row (password, membership, ...) drops it from every lookup in this process."""
+    user_cache.pop(user.id)
+
+
+password_executor = BoundedExecutor(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE'],
+                                    'password-hash')
+auth_ip_limiter = RateLimiter(*app.config['AUTH_IP_RATE'])
+auth_username_limiter = RateLimiter(*app.config['AUTH_USERNAME_RATE'])
+
+
+def run_password_hash(fn, *args, **kwargs):
+    """Run check_password_hash / generate_password_hash on the bounded pool; ExecutorBusy when it is full."""
+    try:
+        return password_executor.submit(fn, *args, **kwargs).result(timeout=app.config['PASSWORD_HASH_TIMEOUT'])
+    except FutureTimeoutError:
+        raise ExecutorBusy()
+
+
+def auth_admission_delay(username):
+    """Seconds this client has to wait before another login/register attempt, 0 when admitted."""
+    if not app.config['AUTH_RATE_LIMIT_ENABLED']:
+        return 0
+    return max(auth_ip_limiter.hit(request.remote_addr or ''), auth_username_limiter.hit(username.lower()))
+
+
+def auth_rejected(template, message, retry_after, status):
+    """Fast rejection page with Retry-After: 429 for a throttled client, 503 when hashing is saturated."""
+    flash(message, 'danger')
+    response = make_response(render_template(template), status)
+    response.headers['Retry-After'] = str(max(int(math.ceil(retry_after)), 1))
+    return response
 
 
 @app.route('/')
@@ -140,8 +473,15 @@ def login():
         if not username or not password:
             flash('请输入用户名和密码', 'danger')
             return redirect(url_for('login'))
+        delay = auth_admission_delay(username)
+        if delay:
+            return auth_rejected('login.html', '尝试次数过多，请稍后再试', delay, 429)
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password_hash, password):
+        try:
+            password_ok = user is not None and run_password_hash(check_password_hash, user.password_hash, password)
+        except ExecutorBusy:
+            return auth_rejected('login.html', '服务器繁忙，请稍后再试', 1, 503)
+        if password_ok:
             login_user(user, remember=True)
             session['username'] = user.username
             return redirect(url_for('notes_page'))
@@ -165,10 +505,16 @@ def register():
         if len(password) < 6:
             flash('密码必须至少6个字符', 'danger')
             return redirect(url_for('register'))
+        delay = auth_admission_delay(username)
+        if delay:
+            return auth_rejected('register.html', '尝试次数过多，请稍后再试', delay, 429)
         if User.query.filter_by(username=username).first():
             flash('用户名已存在', 'danger')
             return redirect(url_for('register'))
-        hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+        try:
+            hashed_password = run_password_hash(generate_password_hash, password, method='pbkdf2:sha256')
+        except ExecutorBusy:
+            return auth_rejected('register.html', '服务器繁忙，请稍后再试', 1, 503)
         new_user = User(username=username, password_hash=hashed_password)
         try:
             db.session.add(new_user)
@@ -190,19 +536,195 @@ def logout():
     return redirect(url_for('login'))
 
 
-@app.route('/notes', defaults={'page': 1})
+# 列表页每条笔记只取正文的前 NOTE_PREVIEW_CHARS 个字符，全文在展开/编辑时单独获取
+NOTE_PREVIEW_CHARS = 1000
+
+
+def note_card_columns():
+    """
+    The columns a note card needs. Bodies are cut down in SQL (one character past the preview,
+    to tell whether anything was cut); gallery/zip member lists are reduced to a count.
+    """
+    preview_length = NOTE_PREVIEW_CHARS + 1
+    return (
+        Note.id, Note.content_type, Note.timestamp, Note.file_size, Note.md5, Note.status,
+        # 图片/文件的 content_data 是存储路径；画廊的 raw_content 可能是旧格式的文件名 JSON
+        case((Note.content_type.in_(['image', 'file']), Note.content_data),
+             (Note.content_type == 'text', func.substr(Note.content_data, 1, preview_length)),
+             else_=None).label('content'),
+        case((Note.content_type == 'gallery', None), else_=Note.raw_content).label('raw_content'),
+        func.substr(Note.additional_text, 1, preview_length).label('additional_text'),
+        case((Note.item_count.isnot(None), Note.item_count),
+             (db.and_(Note.content_type.in_(['gallery', 'zip']), func.json_valid(Note.content_data)),
+              func.json_array_length(Note.content_data)),
+             else_=None).label('item_count'),
+    )
+
+
+class NoteCard:
+    """What a list view shows of a note: previews instead of full bodies. Built from note_card_columns() rows."""
+    __slots__ = ('id', 'content_type', 'timestamp', 'file_size', 'md5', 'status', 'content', 'raw_content',
+                 'additional_text', 'item_count', 'content_truncated', 'additional_text_truncated')
+
+    def __init__(self, row):
+        for name in row._fields:
+            setattr(self, name, getattr(row, name))
+        self.content_truncated = self.content_type == 'text' and len(self.content or '') > NOTE_PREVIEW_CHARS
+        if self.content_truncated:
+            self.content = self.content[:NOTE_PREVIEW_CHARS]
+        self.additional_text_truncated = len(self.additional_text or '') > NOTE_PREVIEW_CHARS
+        if self.additional_text_truncated:
+            self.additional_text = self.additional_text[:NOTE_PREVIEW_CHARS]
+
+
+def note_cards(query):
+    """Run a Note query with the card projection instead of loading whole rows."""
+    return [NoteCard(row) for row in query.with_entities(*note_card_columns())]
+
+
+def note_cards_by_id(note_ids):
+    cards = {card.id: card for card in note_cards(Note.query.filter(Note.id.in_(note_ids)))} if note_ids else {}
+    return [cards[note_id] for note_id in note_ids if note_id in cards]
+
+
+def note_cards_json(cards):
+    """
+    Serialize cards in the note_json shape without per-note url_for calls: the URL prefixes are
+    built once per response.
+    """
+    upload_prefix = url_for('uploaded_file', filename='_')[:-1]
+    thumb_prefixes = {size: url_for('thumbnail', size=size, filename='_')[:-1] for size in app.config['THUMBNAIL_SIZES']}
+    result = []
+    for card in cards:
+        ready_file = card.content_type in ['image', 'file'] and card.status == 'ready'
+        path = quote(card.content) if ready_file else None
+        result.append({
+            'id': card.id,
+            'type': card.content_type,
+            'content': upload_prefix + path if ready_file else card.content if card.content_type == 'text' else None,
+            'content_truncated': card.content_truncated,
+            'raw_content': card.raw_content,
+            'additional_text': card.additional_text,
+            'additional_text_truncated': card.additional_text_truncated,
+            'timestamp': card.timestamp.isoformat(),
+            'file_size': card.file_size,
+            'md5': card.md5,
+            'status': card.status,
+            'item_count': card.item_count,
+            'thumbnails': {size: prefix + path for size, prefix in thumb_prefixes.items()}
+            if ready_file and card.content_type == 'image' else None
+        })
+    return result
+
+
+class KeysetPage:
+    """One page of a user's notes, newest first, with opaque cursors to the neighbouring pages."""
+
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next and bool(items)
+        self.has_prev = has_prev and bool(items)
+
+    @property
+    def next_cursor(self):
+        return encode_note_cursor('after', self.items[-1]) if self.has_next else None
+
+    @property
+    def prev_cursor(self):
+        return encode_note_cursor('before', self.items[0]) if self.has_prev else None
+
+
+def encode_note_cursor(direction, note):
+    raw = json.dumps([direction, note.timestamp.isoformat(), note.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_note_cursor(cursor):
+    """Returns (direction, timestamp, note_id); raises ValueError for a malformed cursor."""
+    try:
+        direction, timestamp, note_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if direction not in ('after', 'before'):
+            raise ValueError(direction)
+        return direction, datetime.fromisoformat(timestamp), int(note_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError('invalid cursor') from e
+
+
+def paginate_notes(user_id, cursor=None, per_page=10):
+    """
+    Keyset pagination on (timestamp, id) over ix_note_user_timestamp: each page is one index
+    range read of per_page + 1 rows, with no OFFSET and no COUNT(*), however deep it is.
+    """
+    query = Note.query.filter(Note.user_id == user_id)
+    if cursor:
+        direction, timestamp, note_id = decode_note_cursor(cursor)
+        key = tuple_(Note.timestamp, Note.id)
+        if direction == 'after':
+            notes = note_cards(query.filter(key < (timestamp, note_id))
+                               .order_by(Note.timestamp.desc(), Note.id.desc()).limit(per_page + 1))
+            page = KeysetPage(notes[:per_page], len(notes) > per_page, True)
+        else:
+            notes = note_cards(query.filter(key > (timestamp, note_id))
+                               .order_by(Note.timestamp.asc(), Note.id.asc()).limit(per_page + 1))
+            page = KeysetPage(notes[:per_page][::-1], True, len(notes) > per_page)
+        # 游标两侧的笔记都被删光时回到第一页
+        if page.items:
+            return page
+    notes = note_cards(query.order_by(Note.timestamp.desc(), Note.id.desc()).limit(per_page + 1))
+    return KeysetPage(notes[:per_page], len(notes) > per_page, False)
+
+
+@app.route('/notes')
+@login_required
+@read_only_db
+def notes_page():
+    try:
+        notes_pagination = paginate_notes(current_user.id, request.args.get('cursor'))
+    except ValueError:
+        return redirect(url_for('notes_page'))
+    return render_template('notes.html', notes=notes_pagination, pagination=notes_pagination,
+                           usage=user_usage(current_user.id), storage_quota=app.config['USER_STORAGE_QUOTA'])
+
+
 @app.route('/notes/page/<int:page>')
 @login_required
-def notes_page(page):
-    per_page = 10
-    notes_pagination = Note.query.filter_by(user_id=current_user.id).order_by(Note.timestamp.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
-    )
-    return render_template('notes.html', notes=notes_pagination, pagination=notes_pagination)
+def legacy_notes_page(page):
+    # 旧的页码链接统一回到第一页
+    return redirect(url_for('notes_page'))
+
+
+@app.route('/api/notes')
+@login_required
+@read_only_db
+def list_notes_api():
+    """JSON listing of the current user's notes, paged with the same cursors as the notes page."""
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    try:
+        page = paginate_notes(current_user.id, request.args.get('cursor'), limit)
+    except ValueError:
+        return jsonify({'success': False, 'error': '无效的分页游标'}), 400
+    return jsonify({
+        'success': True,
+        'notes': note_cards_json(page.items),
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor
+    })
+
+
+@app.route('/notes/<int:note_id>')
+@login_required
+@read_only_db
+def get_note(note_id):
+    """One note with its full text; the list views only carry previews."""
+    note = Note.query.get_or_404(note_id)
+    if note.user_id != current_user.id:
+        return jsonify({'success': False, 'error': '无权访问此笔记'}), 403
+    return jsonify({'success': True, 'note': note_json(note)})
 
 
 @app.route('/notes/gallery/<int:note_id>')
 @login_required
+@read_only_db
 def gallery_page(note_id):
     note = Note.query.get_or_404(note_id)
     if note.user_id != current_user.id:
@@ -212,16 +734,570 @@ def gallery_page(note_id):
         flash('无效的画廊笔记', 'danger')
         return redirect(url_for('notes_page'))
     try:
-        image_paths = json.loads(note.content_data)
-        raw_contents = json.loads(note.raw_content) if note.raw_content else [os.path.basename(path) for path in
-                                                                              image_paths]
-        return render_template('gallery.html', note=note, image_paths=image_paths, raw_contents=raw_contents)
+        # 图片列表由页面按需分页拉取
+        return render_template('gallery.html', note=note, item_count=note_item_count(note),
+                               page_size=app.config['GALLERY_PAGE_SIZE'])
     except Exception as e:
         logger.error(f"Gallery page failed: {str(e)}")
         flash('加载画廊失败', 'danger')
         return redirect(url_for('notes_page'))
 
 
+def legacy_note_items(note):
+    """Members of a gallery/zip note not yet moved out of its content_data JSON, as unsaved NoteItems."""
+    try:
+        paths = json.loads(note.content_data)
+    except (json.JSONDecodeError, TypeError):
+        logger.warning(f"Could not parse content_data for note {note.id}")
+        return []
+    # 画廊的 raw_content 是原始文件名列表；zip 笔记的 raw_content 是压缩包名
+    names = fromjson_filter(note.raw_content) if note.content_type == 'gallery' else []
+    if not isinstance(names, list) or len(names) != len(paths):
+        names = [os.path.basename(path) for path in paths]
+    return [NoteItem(note_id=note.id, ordinal=i, path=path, filename=name) for i, (path, name) in
+            enumerate(zip(paths, names))]
+
+
+def note_members(note):
+    """All member files of a gallery/zip note in order."""
+    if note.item_count is None:
+        return legacy_note_items(note)
+    return NoteItem.query.filter_by(note_id=note.id).order_by(NoteItem.ordinal).all()
+
+
+def note_item_count(note):
+    return len(legacy_note_items(note)) if note.item_count is None else note.item_count
+
+
+def gallery_item_json(item):
+    return {
+        'ordinal': item.ordinal,
+        'url': url_for('uploaded_file', filename=item.path),
+        'thumbnail': url_for('thumbnail', size='sm', filename=item.path),
+        'thumbnail_2x': url_for('thumbnail', size='md', filename=item.path),
+        'filename': item.filename or os.path.basename(item.path),
+        'file_size': item.file_size,
+        'md5': item.md5
+    }
+
+
+@app.route('/notes/gallery/<int:note_id>/items')
+@login_required
+@read_only_db
+def gallery_items(note_id):
+    """
+    One page of gallery members, keyset-paginated on ordinal.
+    Pass the returned next_cursor back as ?cursor= to continue; it is null on the last page.
+    """
+    note = Note.query.get_or_404(note_id)
+    if note.user_id != current_user.id:
+        return jsonify({'success': False, 'error': '无权访问此画廊'}), 403
+    if note.content_type not in ['gallery', 'zip']:
+        return jsonify({'success': False, 'error': '无效的画廊笔记'}), 400
+    try:
+        cursor = int(request.args.get('cursor', -1))
+        limit = min(max(int(request.args.get('limit', app.config['GALLERY_PAGE_SIZE'])), 1), 100)
+    except ValueError:
+        return jsonify({'success': False, 'error': '参数无效'}), 400
+
+    if note.item_count is None:
+        items = [item for item in legacy_note_items(note) if item.ordinal > cursor][:limit + 1]
+    else:
+        items = note.items.filter(NoteItem.ordinal > cursor).limit(limit + 1).all()
+    has_more = len(items) > limit
+    items = items[:limit]
+    return jsonify({
+        'success': True,
+        'items': [gallery_item_json(item) for item in items],
+        'next_cursor': items[-1].ordinal if has_more else None,
+        'total': note_item_count(note)
+    })
+
+
+def blob_relpath(md5_digest, filename):
+    ext = os.path.splitext(secure_filename(filename))[1].lower()
+    return f"{BLOB_SUBDIR}/{md5_digest[:2]}/{md5_digest}{ext}"
+
+
+def store_blob(src_path, md5_digest, file_size, filename):
+    """
+    Move a finished file into the blob store and return its Blob (commits).
+    If the content is already stored the new copy is simply dropped.
+    New blobs start with ref_count 0; notes take references via acquire_blob.
+    """
+    blob = db.session.get(Blob, md5_digest)
+    if blob and not touch_blob(md5_digest):
+        blob = None  # 存储回收刚删除了这条记录，按新内容重新存入
+    if blob and os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], blob.path)):
+        os.remove(src_path)
+        return blob
+    relpath = blob.path if blob else blob_relpath(md5_digest, filename)
+    blob_path = os.path.join(app.config['UPLOAD_FOLDER'], relpath)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    os.replace(src_path, blob_path)
+    if blob:
+        return blob
+    db.session.add(Blob(md5=md5_digest, size=file_size, path=relpath, ref_count=0))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 并发上传了同样的内容，对方已经登记，文件内容一致无需处理
+        db.session.rollback()
+    return db.session.get(Blob, md5_digest)
+
+
+def touch_blob(md5_digest):
+    """
+    Restart the storage GC grace period of a blob about to be handed out again (commits).
+    Returns False if the row is gone, e.g. collected a moment ago.
+    """
+    touched = Blob.query.filter_by(md5=md5_digest).update({'last_seen': datetime.now(timezone.utc)},
+                                                          synchronize_session=False)
+    db.session.commit()
+    return bool(touched)
+
+
+def thumbnail_relpath(path, size):
+    """Thumbnails sit next to the original: blobs/ab/<md5>.png -> blobs/ab/<md5>.sm.webp"""
+    return f"{os.path.splitext(path)[0]}.{size}.{app.config['THUMBNAIL_FORMAT']}"
+
+
+def ensure_thumbnails(path):
+    """Render any missing thumbnail sizes for a stored image (path relative to UPLOAD_FOLDER)."""
+    targets = {}
+    for size, edge in app.config['THUMBNAIL_SIZES'].items():
+        thumb_path = os.path.join(app.config['UPLOAD_FOLDER'], thumbnail_relpath(path, size))
+        if not os.path.isfile(thumb_path):
+            targets[thumb_path] = edge
+    if not targets:
+        return 0
+    return render_thumbnails(os.path.join(app.config['UPLOAD_FOLDER'], path), targets,
+                             app.config['THUMBNAIL_FORMAT'], app.config['THUMBNAIL_QUALITY'])
+
+
+def remove_stored_file(file_path):
+    """Unlink a stored file (absolute path) together with its thumbnails."""
+    root = os.path.splitext(file_path)[0]
+    for path in [file_path] + [f"{root}.{size}.{app.config['THUMBNAIL_FORMAT']}"
+                               for size in app.config['THUMBNAIL_SIZES']]:
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Failed to remove {path}: {e}")
+
+
+def acquire_blob(md5_digest, count=1):
+    """Take references in the current transaction; False when the blob has been purged meanwhile."""
+    return Blob.query.filter_by(md5=md5_digest).update({'ref_count': Blob.ref_count + count}) == 1
+
+
+def release_upload_files(paths):
+    """
+    Drop one reference per stored path in the current transaction.
+    Returns (blob md5s that may now be unreferenced, legacy flat files to unlink after commit).
+    """
+    counts = Counter(paths)
+    if not counts:
+        return [], []
+    blobs = {blob.path: blob.md5 for blob in Blob.query.filter(Blob.path.in_(list(counts)))}
+    legacy_paths = []
+    for path, count in counts.items():
+        if path in blobs:
+            Blob.query.filter_by(md5=blobs[path]).update({'ref_count': Blob.ref_count - count})
+        else:
+            legacy_paths.append(os.path.join(app.config['UPLOAD_FOLDER'], path))
+    return list(blobs.values()), legacy_paths
+
+
+def purge_unreferenced_blobs(md5_digests):
+    """Delete blobs whose ref_count reached 0, row first so a concurrent acquire_blob cannot resurrect it."""
+    for md5_digest in md5_digests:
+        blob = db.session.get(Blob, md5_digest)
+        if not blob:
+            continue
+        path = os.path.join(app.config['UPLOAD_FOLDER'], blob.path)
+        deleted = Blob.query.filter(Blob.md5 == md5_digest, Blob.ref_count <= 0).delete(synchronize_session=False)
+        db.session.commit()
+        if deleted:
+            remove_stored_file(path)
+
+
+def note_file_paths(note):
+    """Stored paths (relative to UPLOAD_FOLDER) referenced by a note, one entry per reference."""
+    if note.content_type in ['zip', 'gallery']:
+        if note.item_count is None:
+            return [item.path for item in legacy_note_items(note)]
+        return [path for (path,) in db.session.query(NoteItem.path).filter_by(note_id=note.id)]
+    if note.content_type in ['image', 'file'] and note.status == 'ready':
+        return [note.content_data]
+    return []
+
+
+def user_owns_file(user_id, path):
+    """
+    Whether one of the user's notes references the stored file at path (relative to UPLOAD_FOLDER).
+    Blob names are their MD5, so the usual case is an indexed lookup; other paths scan the user's notes.
+    """
+    owned = db.session.query(Note.id).filter(Note.user_id == user_id)
+    if path.startswith(f'{BLOB_SUBDIR}/'):
+        md5_digest = os.path.splitext(os.path.basename(path))[0]
+        if owned.filter(Note.md5 == md5_digest, Note.content_data == path).first() or \
+                owned.join(NoteItem, NoteItem.note_id == Note.id) \
+                .filter(NoteItem.md5 == md5_digest, NoteItem.path == path).first():
+            return True
+    if owned.filter(Note.content_data == path).first() or \
+            owned.join(NoteItem, NoteItem.note_id == Note.id).filter(NoteItem.path == path).first():
+        return True
+    # 尚未迁移的画廊/压缩包，成员路径还在 content_data 的 JSON 里
+    return owned.filter(Note.item_count.is_(None), Note.content_type.in_(['zip', 'gallery']),
+                        Note.content_data.contains(json.dumps(path), autoescape=True)).first() is not None
+
+
+def delete_user_notes(user_id, note_ids, chunk_size=500):
+    """
+    Delete the user's notes among note_ids in the current transaction, a few set-based statements
+    per chunk instead of a round of queries per note. Returns (number deleted, released blob md5s,
+    legacy files to unlink); pass the last two to queue_file_purge, which also commits.
+    """
+    deleted, size, paths = 0, 0, []
+    for start in range(0, len(note_ids), chunk_size):
+        # 只取删除需要的列；文本笔记的正文不读出来
+        notes = db.session.query(
+            Note.id, Note.content_type, Note.status, Note.item_count, Note.file_size,
+            case((Note.content_type.in_(['image', 'file', 'gallery', 'zip']), Note.content_data)).label('content_data'),
+            case((Note.content_type == 'gallery', Note.raw_content)).label('raw_content')
+        ).filter(Note.user_id == user_id, Note.id.in_(note_ids[start:start + chunk_size])).all()
+        if not notes:
+            continue
+        ids = [note.id for note in notes]
+        item_note_ids = [note.id for note in notes if note.content_type in ['zip', 'gallery']
+                         and note.item_count is not None]
+        for note in notes:
+            if note.id not in item_note_ids:
+                paths.extend(note_file_paths(note))
+        if item_note_ids:
+            paths.extend(path for (path,) in
+                         db.session.query(NoteItem.path).filter(NoteItem.note_id.in_(item_note_ids)))
+            NoteItem.query.filter(NoteItem.note_id.in_(item_note_ids)).delete(synchronize_session=False)
+        unindex_notes(ids)
+        unshare_notes(ids)
+        # 任务不引用已删除的笔记，免得 id 被复用后指向别人的笔记
+        Job.query.filter(Job.user_id == user_id, Job.note_id.in_(ids)) \
+            .update({'note_id': None}, synchronize_session=False)
+        Note.query.filter(Note.id.in_(ids)).delete(synchronize_session=False)
+        deleted += len(ids)
+        size += sum(note.file_size or 0 for note in notes)
+    released_blobs, legacy_paths = release_upload_files(paths)
+    if deleted:
+        adjust_usage(user_id, -deleted, -size)
+    return deleted, released_blobs, legacy_paths
+
+
+def measure_usage(user_id):
+    """(note count, stored bytes) straight from the note table; the slow path the counters replace."""
+    note_count, storage_bytes = db.session.query(func.count(Note.id), func.coalesce(func.sum(Note.file_size), 0)) \
+        .filter(Note.user_id == user_id).one()
+    return note_count, storage_bytes
+
+
+def user_usage(user_id):
+    """The user's usage counters; users without a row yet get a transient one measured on the spot."""
+    usage = db.session.get(UserUsage, user_id)
+    if usage is None:
+        note_count, storage_bytes = measure_usage(user_id)
+        usage = UserUsage(user_id=user_id, note_count=note_count, storage_bytes=storage_bytes)
+    return usage
+
+
+def reconcile_user_usage(user_id):
+    """Recompute one user's counters in the current transaction. Returns the drift that was repaired."""
+    note_count, storage_bytes = measure_usage(user_id)
+    usage = db.session.get(UserUsage, user_id)
+    drift = (note_count - usage.note_count, storage_bytes - usage.storage_bytes) if usage else (0, 0)
+    values = {'note_count': note_count, 'storage_bytes': storage_bytes, 'reconciled_at': datetime.now(timezone.utc)}
+    db.session.execute(sqlite_insert(UserUsage).values(user_id=user_id, **values)
+                       .on_conflict_do_update(index_elements=[UserUsage.user_id], set_=values))
+    if usage:
+        db.session.expire(usage)
+    return drift
+
+
+def adjust_usage(user_id, notes=0, size=0):
+    """
+    Apply a note count / byte delta in the current transaction, so the counters commit or roll back
+    with the note change itself. Call after the change is flushed: a missing row is built by measuring.
+    """
+    updated = UserUsage.query.filter_by(user_id=user_id).update({
+        'note_count': UserUsage.note_count + notes,
+        'storage_bytes': UserUsage.storage_bytes + (size or 0)
+    })
+    if not updated:
+        reconcile_user_usage(user_id)
+
+
+def reconcile_usage(batch_size=None, max_age=None):
+    """
+    Re-measure the counters of users not reconciled within max_age (all users when max_age is None),
+    batch_size users per commit. Returns how many users had drifted.
+    """
+    batch_size = batch_size or app.config['USAGE_RECONCILE_BATCH']
+    cutoff = datetime.now(timezone.utc) - max_age if max_age else None
+    last_id = 0
+    drifted = 0
+    while True:
+        query = db.session.query(User.id).outerjoin(UserUsage, UserUsage.user_id == User.id).filter(User.id > last_id)
+        if cutoff:
+            query = query.filter(db.or_(UserUsage.reconciled_at.is_(None), UserUsage.reconciled_at < cutoff))
+        user_ids = [user_id for (user_id,) in query.order_by(User.id).limit(batch_size)]
+        if not user_ids:
+            break
+        for user_id in user_ids:
+            drift = reconcile_user_usage(user_id)
+            if drift != (0, 0):
+                drifted += 1
+                logger.warning(f"Usage counters for user {user_id} drifted by {drift[0]} notes, {drift[1]} bytes")
+        db.session.commit()
+        last_id = user_ids[-1]
+    return drifted
+
+
+@app.cli.command('reconcile-usage')
+def reconcile_usage_command():
+    """Recompute every user's usage counters from the note table."""
+    print(f"已校正 {reconcile_usage()} 个用户的用量计数")
+
+
+def storage_quota_error(user_id, extra_bytes):
+    """Error response when storing extra_bytes more would exceed USER_STORAGE_QUOTA, else None."""
+    quota = app.config['USER_STORAGE_QUOTA']
+    if quota is not None and user_usage(user_id).storage_bytes + extra_bytes > quota:
+        return jsonify({'success': False, 'error': '存储空间不足，请删除部分笔记后再上传'}), 400
+    return None
+
+
+# 全文索引：FTS5 虚拟表，rowid 即 note.id。trigram 分词支持中文子串匹配，但查询词至少 3 个字符。
+# owner 列存用户标记并写进 MATCH，检索和 bm25 打分只在该用户自己的笔记里进行
+SEARCH_INDEX_DDL = ("CREATE VIRTUAL TABLE IF NOT EXISTS note_fts USING fts5("
+                    "body, additional_text, filenames, owner, tokenize='trigram')")
+SEARCH_MIN_TERM_LENGTH = 3
+SNIPPET_OPEN, SNIPPET_CLOSE = '\x02', '\x03'  # 先用控制字符标记命中，转义 HTML 后再换成 <mark>
+event.listen(Note.__table__, 'after_create', DDL(SEARCH_INDEX_DDL))
+search_index_ready = False
+
+
+def search_index_available():
+    """
+    True once note_fts exists with its owner column; older databases get it from migrations 009/013
+    in migrate_db.py or `flask rebuild-search-index`.
+    """
+    global search_index_ready
+    if not search_index_ready:
+        search_index_ready = db.session.execute(
+            text("SELECT 1 FROM pragma_table_info('note_fts') WHERE name = 'owner'")).first() is not None
+    return search_index_ready
+
+
+def search_owner(user_id):
+    """
+    The owner column value for a user's notes. trigram matches substrings, so the id is bracketed:
+    the phrase "<12>" cannot match inside "<123>".
+    """
+    return f'<{user_id}>'
+
+
+def note_search_fields(note):
+    """(body, additional_text, filenames) as indexed for a note."""
+    if note.content_type == 'text':
+        return note.content_data, note.additional_text or '', ''
+    if note.content_type in ['gallery', 'zip']:
+        names = [item.filename or os.path.basename(item.path) for item in note_members(note)]
+        if note.content_type == 'zip' and note.raw_content:
+            names.insert(0, note.raw_content)
+        return '', note.additional_text or '', '\n'.join(names)
+    return '', note.additional_text or '', note.raw_content or ''
+
+
+def index_note(note):
+    """Write a note's searchable text in the current transaction; the note must be flushed."""
+    if not search_index_available():
+        return
+    body, additional_text, filenames = note_search_fields(note)
+    db.session.execute(text("DELETE FROM note_fts WHERE rowid = :id"), {'id': note.id})
+    db.session.execute(
+        text("INSERT INTO note_fts (rowid, body, additional_text, filenames, owner) "
+             "VALUES (:id, :body, :additional_text, :filenames, :owner)"),
+        {'id': note.id, 'body': body, 'additional_text': additional_text, 'filenames': filenames,
+         'owner': search_owner(note.user_id)})
+
+
+def unindex_notes(note_ids):
+    if note_ids and search_index_available():
+        db.session.execute(text("DELETE FROM note_fts WHERE rowid IN :ids").bindparams(bindparam('ids', expanding=True)),
+                           {'ids': list(note_ids)})
+
+
+def rebuild_search_index(batch_size=500):
+    """Recreate note_fts from the note table in batches; returns the number of notes indexed."""
+    global search_index_ready
+    db.session.execute(text("DROP TABLE IF EXISTS note_fts"))
+    db.session.execute(text(SEARCH_INDEX_DDL))
+    db.session.commit()
+    search_index_ready = True
+    last_id = 0
+    indexed = 0
+    while True:
+        notes = Note.query.filter(Note.id > last_id).order_by(Note.id).limit(batch_size).all()
+        if not notes:
+            break
+        for note in notes:
+            index_note(note)
+        last_id = notes[-1].id
+        indexed += len(notes)
+        db.session.commit()
+    return indexed
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Drop and rebuild the full-text search index."""
+    print(f"✅ 已重建搜索索引：{rebuild_search_index()} 条笔记")
+
+
+def highlight_snippet(raw):
+    return html.escape(raw).replace(SNIPPET_OPEN, '<mark>').replace(SNIPPET_CLOSE, '</mark>')
+
+
+def like_snippet(note, terms, width=48):
+    """Snippet for the LIKE fallback: the first hit in the note's text, with every term marked."""
+    lowered_terms = [term.lower() for term in terms]
+    for field in note_search_fields(note):
+        position = field.lower().find(lowered_terms[0])
+        if position < 0:
+            continue
+        start = max(position - width // 2, 0)
+        piece = field[start:start + width]
+        marked = html.escape(piece)
+        for term in terms:
+            marked = re.sub(re.escape(html.escape(term)), lambda m: f'<mark>{m.group(0)}</mark>', marked,
+                            flags=re.IGNORECASE)
+        return ('…' if start > 0 else '') + marked + ('…' if start + width < len(field) else '')
+    return ''
+
+
+MD5_PREFIX_PATTERN = re.compile(r'^[0-9a-f]{8,32}$')
+MD5_SEARCH_MAX_HITS = 1000
+
+
+def md5_prefix_range(column, prefix):
+    """
+    `column LIKE 'prefix%'` written as a range so SQLite can walk the index:
+    every hex digest starting with prefix sorts in [prefix, prefix + 'g').
+    """
+    return db.and_(column >= prefix, column < prefix + 'g')
+
+
+def md5_prefix_hits(user_id, prefix):
+    """
+    Ids of the user's notes whose own MD5, or one of whose gallery/zip members' MD5, starts with prefix,
+    and whether more than MD5_SEARCH_MAX_HITS matched (only that many are returned).
+    """
+    note_ids = db.session.query(Note.id).filter(Note.user_id == user_id, md5_prefix_range(Note.md5, prefix))
+    item_note_ids = db.session.query(NoteItem.note_id).join(Note, Note.id == NoteItem.note_id) \
+        .filter(md5_prefix_range(NoteItem.md5, prefix), Note.user_id == user_id)
+    hits = [note_id for (note_id,) in note_ids.union(item_note_ids).limit(MD5_SEARCH_MAX_HITS + 1)]
+    return set(hits[:MD5_SEARCH_MAX_HITS]), len(hits) > MD5_SEARCH_MAX_HITS
+
+
+def md5_snippet(note, prefix, matched_items):
+    if note.md5 and note.md5.startswith(prefix):
+        return f'MD5: <mark>{prefix}</mark>{note.md5[len(prefix):]}'
+    return '<br>'.join(f'{html.escape(item.filename or os.path.basename(item.path))} · MD5: '
+                       f'<mark>{prefix}</mark>{item.md5[len(prefix):]}' for item in matched_items.get(note.id, []))
+
+
+def search_md5(prefix, page, per_page):
+    """MD5 prefix search (at least 8 hex digits), newest first. Returns (hits, has_more, truncated)."""
+    note_ids, truncated = md5_prefix_hits(current_user.id, prefix)
+    notes = note_cards(Note.query.filter(Note.id.in_(note_ids)).order_by(Note.timestamp.desc(), Note.id.desc())
+                       .offset((page - 1) * per_page).limit(per_page + 1)) if note_ids else []
+    has_more = len(notes) > per_page
+    notes = notes[:per_page]
+    matched_items = {}
+    for item in NoteItem.query.filter(NoteItem.note_id.in_([note.id for note in notes]),
+                                      md5_prefix_range(NoteItem.md5, prefix)).order_by(NoteItem.ordinal):
+        matched_items.setdefault(item.note_id, []).append(item)
+    return [(note, md5_snippet(note, prefix, matched_items)) for note in notes], has_more, truncated
+
+
+@app.route('/notes/search')
+@login_required
+@read_only_db
+def search_notes():
+    """
+    Search the current user's notes, one page at a time.
+    mode=text: ranked full-text search over note text, additional text and file names.
+    mode=md5: MD5 prefix search (8-32 hex digits), including gallery/zip members.
+    mode=auto (default): MD5 search when the query looks like a hash and matches, text search otherwise.
+    """
+    query = request.args.get('q', '').strip()
+    mode = request.args.get('mode', 'auto')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+    if not query:
+        return jsonify({'success': False, 'error': '请输入搜索内容'}), 400
+
+    if mode in ['auto', 'md5']:
+        prefix = query.lower()
+        if MD5_PREFIX_PATTERN.match(prefix):
+            hits, has_more, truncated = search_md5(prefix, page, per_page)
+            if hits or mode == 'md5':
+                return search_response(hits, page, has_more, 'md5', truncated)
+        elif mode == 'md5':
+            return jsonify({'success': False, 'error': 'MD5 搜索至少需要 8 位十六进制字符'}), 400
+
+    terms = query.split()
+    offset = (page - 1) * per_page
+    if search_index_available() and all(len(term) >= SEARCH_MIN_TERM_LENGTH for term in terms):
+        phrases = ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+        match = f'owner : "{search_owner(current_user.id)}" AND {{body additional_text filenames}} : ({phrases})'
+        rows = db.session.execute(text(
+            "SELECT rowid, snippet(note_fts, -1, :open, :close, '…', 40) FROM note_fts "
+            "WHERE note_fts MATCH :match "
+            "ORDER BY bm25(note_fts, 1.0, 1.0, 0.5, 0) LIMIT :limit OFFSET :offset"),
+            {'open': SNIPPET_OPEN, 'close': SNIPPET_CLOSE, 'match': match,
+             'limit': per_page + 1, 'offset': offset}).all()
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        snippets = {note_id: highlight_snippet(snippet) for note_id, snippet in rows}
+        hits = [(card, snippets[card.id]) for card in note_cards_by_id([row[0] for row in rows])]
+    else:
+        # trigram 无法匹配过短的词，退回到有分页上限的 LIKE 查询
+        conditions = [db.or_(db.and_(Note.content_type == 'text', Note.content_data.contains(term, autoescape=True)),
+                             Note.additional_text.contains(term, autoescape=True),
+                             Note.raw_content.contains(term, autoescape=True)) for term in terms]
+        notes = Note.query.filter(Note.user_id == current_user.id, *conditions) \
+            .order_by(Note.timestamp.desc()).offset(offset).limit(per_page + 1).all()
+        has_more = len(notes) > per_page
+        # 片段要从全文里截取，结果本身仍按卡片返回
+        snippets = {note.id: like_snippet(note, terms) for note in notes[:per_page]}
+        hits = [(card, snippets[card.id]) for card in note_cards_by_id(list(snippets))]
+    return search_response(hits, page, has_more, 'text')
+
+
+def search_response(hits, page, has_more, mode, truncated=False):
+    """truncated: the MD5 prefix matched more than MD5_SEARCH_MAX_HITS notes and only those are paged through."""
+    return jsonify({
+        'success': True,
+        'mode': mode,
+        'results': [{'note': card, 'snippet': snippet} for card, snippet in
+                    zip(note_cards_json([card for card, _ in hits]), [snippet for _, snippet in hits])],
+        'page': page,
+        'has_more': has_more,
+        'truncated': truncated
+    })
+
+
 @app.route('/notes/add', methods=['POST'])
 @login_required
 def add_note():
@@ -251,17 +1327,22 @@ def add_note():
                 return jsonify({'success': False, 'error': '文件过大，最大200MB'}), 400
             if not allowed_file(filename, file_data):
                 return jsonify({'success': False, 'error': '不支持的文件类型'}), 400
+            quota_error = storage_quota_error(user_id, len(file_data))
+            if quota_error:
+                return quota_error
 
             md5_hash = hashlib.md5(file_data).hexdigest()
             existing_note = Note.query.filter_by(user_id=user_id, md5=md5_hash).first()
             if existing_note:
                 return jsonify({'success': False, 'error': '文件已存在，无需重复上传'}), 409
 
-            safe_filename = secure_filename(f"{md5_hash}_{filename}")
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], safe_filename)
-            with open(file_path, 'wb') as f:
-                f.write(file_data)
-            new_note.content_data = safe_filename
+            blob = db.session.get(Blob, md5_hash)
+            if not blob:
+                tmp_path = os.path.join(app.config['TEMP_CHUNK_DIR'], f'{user_id}-{md5_hash}.tmp')
+                with open(tmp_path, 'wb') as f:
+                    f.write(file_data)
+                blob = store_blob(tmp_path, md5_hash, len(file_data), filename)
+            new_note.content_data = blob.path
             new_note.raw_content = filename
             new_note.file_size = len(file_data)
             new_note.md5 = md5_hash
@@ -270,133 +1351,1013 @@ def add_note():
 
     try:
         db.session.add(new_note)
+        if note_type == 'image' and not acquire_blob(new_note.md5):
+            db.session.rollback()
+            return jsonify({'success': False, 'error': '文件保存失败，请重试'}), 500
+        db.session.flush()
+        index_note(new_note)
+        adjust_usage(new_note.user_id, 1, new_note.file_size)
         db.session.commit()
-        return jsonify({
-            'success': True,
-            'note': {
-                'id': new_note.id,
-                'type': new_note.content_type,
-                'content': new_note.content_data if note_type == 'text' else url_for('uploaded_file',
-                                                                                     filename=new_note.content_data),
-                'raw_content': new_note.raw_content,
-                'timestamp': new_note.timestamp.isoformat(),
-                'file_size': new_note.file_size,
-                'md5': new_note.md5,
-                'additional_text': new_note.additional_text
-            }
-        })
+        return jsonify({'success': True, 'note': note_json(new_note)})
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': f'数据库错误: {str(e)}'}), 500
 
 
-@app.route('/notes/upload_chunk', methods=['POST'])
+@app.route('/notes/upload_file', methods=['POST'])
 @login_required
-def upload_chunk():
+def upload_file():
+    """
+    Single-request upload for pasted and dropped files.
+    Accepts multipart (field `file`) or a raw body with ?filename=...; the bytes are hashed
+    and written to disk block by block, so memory stays bounded whatever the file size.
+    """
     user_id = current_user.id
-    chunk = request.files.get('chunk')
-    filename = request.form.get('filename')
-    chunk_index = int(request.form.get('chunkIndex', -1))
-    total_chunks = int(request.form.get('totalChunks', -1))
-    chunk_id = request.form.get('chunkId')
-    mode = request.form.get('mode', 'file')
-    additional_text = request.form.get('additional_text', '').strip()
+    if request.mimetype == 'multipart/form-data':
+        file = request.files.get('file')
+        stream = file.stream if file else None
+        filename = request.form.get('filename') or (file.filename if file else None)
+        additional_text = request.form.get('additional_text', '').strip()
+    else:
+        stream = request.stream
+        filename = request.args.get('filename')
+        additional_text = request.args.get('additional_text', '').strip()
+    if not stream or not filename:
+        return jsonify({'success': False, 'error': '文件名缺失'}), 400
+    if os.path.splitext(filename)[1].lower() not in ALLOWED_EXTENSIONS:
+        return jsonify({'success': False, 'error': '不支持的文件类型'}), 400
+
+    tmp_path = os.path.join(app.config['TEMP_CHUNK_DIR'], f'{user_id}-{os.urandom(8).hex()}.upload')
+    try:
+        file_size, md5_hash = stream_to_file(stream, tmp_path, app.config['MAX_CONTENT_LENGTH'])
+        if file_size == 0:
+            raise ValueError('empty file')
+        if Note.query.filter_by(user_id=user_id, md5=md5_hash).first():
+            os.remove(tmp_path)
+            return jsonify({'success': False, 'error': '文件已存在，无需重复上传'}), 409
+        quota_error = storage_quota_error(user_id, file_size)
+        if quota_error:
+            os.remove(tmp_path)
+            return quota_error
+        # 类型检查和入库交给后台任务，请求只负责把字节收下来
+        return queue_upload(user_id, tmp_path, filename, md5_hash, file_size, 'file', additional_text)
+    except (ValueError, RequestEntityTooLarge):
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        return jsonify({'success': False, 'error': '文件为空或过大，最大200MB'}), 400
+    except Exception as e:
+        db.session.rollback()
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        return jsonify({'success': False, 'error': f'文件保存失败: {str(e)}'}), 500
 
-    if not chunk or not filename or chunk_index < 0 or total_chunks < 0 or not chunk_id:
-        return jsonify({'success': False, 'error': '缺少必要参数或参数无效'}), 400
 
-    chunk_dir = os.path.join(app.config['TEMP_CHUNK_DIR'], chunk_id)
-    os.makedirs(chunk_dir, exist_ok=True)
-    chunk_path = os.path.join(chunk_dir, f'chunk-{chunk_index}')
+def upload_session_key(user_id, chunk_id):
+    """Client chunk ids are only unique per user, so sessions are namespaced by owner."""
+    return f"{user_id}-{secure_filename(chunk_id or '')}"
+
+
+def get_chunk_assembly(upload):
+    """
+    Return the cached assembly for an upload session, rebuilding it from the DB after a restart,
+    an eviction, or when the row was recreated under the same id (possibly by another worker).
+    """
+    generation = upload.created_at.replace(tzinfo=None)
+    with upload_sessions_lock:
+        cached = upload_sessions.get(upload.id)
+        if cached is not None and cached[0] == generation:
+            assembly = cached[1]
+        else:
+            assembly = ChunkAssembly(upload.part_path, upload.file_size, upload.chunk_size, upload.total_chunks)
+            if os.path.exists(upload.part_path):
+                assembly.sync_received(row.chunk_index for row in upload.chunks)
+            else:
+                assembly.preallocate()
+        # 每次使用都重新计时，只有闲置的会话会过期
+        upload_sessions.set(upload.id, (generation, assembly))
+        return assembly
+
+
+def drop_upload_session(upload, discard_file=True):
+    """Forget an upload session and delete its row; the caller commits."""
+    with upload_sessions_lock:
+        upload_sessions.pop(upload.id)
+    if discard_file and os.path.exists(upload.part_path):
+        try:
+            os.remove(upload.part_path)
+        except OSError as e:
+            logger.warning(f"Failed to remove {upload.part_path}: {e}")
+    db.session.delete(upload)
+
+
+def reap_upload_sessions():
+    """Expire upload sessions idle for longer than UPLOAD_SESSION_TTL and reclaim their disk."""
+    cutoff = datetime.now(timezone.utc) - app.config['UPLOAD_SESSION_TTL']
+    reclaimed = 0
+    stale_sessions = UploadSession.query.filter(UploadSession.updated_at < cutoff).all()
+    for upload in stale_sessions:
+        if os.path.exists(upload.part_path):
+            reclaimed += os.path.getsize(upload.part_path)
+        drop_upload_session(upload)
+    db.session.commit()
+
+    # 旧版合并方式遗留的 chunk 目录，以及没有会话记录的 .part 文件
+    live_parts = {f'{session_id}.part' for (session_id,) in db.session.query(UploadSession.id)}
+    # 排队中的后台任务还要用到它们暂存的文件
+    for (payload,) in db.session.query(Job.payload).filter(Job.kind == 'process_upload',
+                                                           Job.status.in_(['pending', 'running'])):
+        live_parts.add(json.loads(payload)['path'])
+    temp_dir = app.config['TEMP_CHUNK_DIR']
+    for entry in os.scandir(temp_dir):
+        if entry.name in live_parts:
+            continue
+        try:
+            if datetime.fromtimestamp(entry.stat().st_mtime, timezone.utc) >= cutoff:
+                continue
+            if entry.is_dir():
+                reclaimed += sum(os.path.getsize(f) for f in glob.glob(os.path.join(entry.path, '*')))
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                reclaimed += entry.stat().st_size
+                os.remove(entry.path)
+        except OSError as e:
+            logger.warning(f"Failed to reap {entry.path}: {e}")
+    if stale_sessions or reclaimed:
+        logger.info(f"Reaped {len(stale_sessions)} stale upload sessions, reclaimed {reclaimed} bytes")
+    return reclaimed
+
+
+def load_checkpoint(name, default=None):
+    checkpoint = db.session.get(WorkerCheckpoint, name)
+    return json.loads(checkpoint.value) if checkpoint else default
+
+
+def save_checkpoint(name, value):
+    """Record a sweep's position in the current transaction; the caller commits."""
+    db.session.merge(WorkerCheckpoint(name=name, value=json.dumps(value), updated_at=datetime.now(timezone.utc)))
+
+
+# 一轮存储回收：256 个 blob 分片目录，最后是 UPLOAD_FOLDER 根目录下的旧文件
+STORAGE_GC_STEPS = [f'{i:02x}' for i in range(256)] + ['legacy']
+
+
+def unlink_files(paths):
+    """Remove files and return the bytes freed; failures are logged and retried on the next round."""
+    freed = 0
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            freed += size
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to remove {path}: {e}")
+    return freed
+
+
+def reclaim_files(files, report, dry_run):
+    """files: [(path, size)]"""
+    report['files'] += len(files)
+    report['bytes'] += sum(size for _, size in files) if dry_run else unlink_files(path for path, _ in files)
+
+
+def gc_blob_shard(shard, cutoff, report, dry_run=False):
+    """
+    Reconcile one blobs/<shard>/ directory with the Blob rows whose md5 starts with shard: one directory
+    listing and one primary-key range read. Removes unreferenced blob rows and files with no row once they
+    are older than cutoff; counts referenced blobs whose file is missing.
+    """
+    shard_dir = os.path.join(app.config['UPLOAD_FOLDER'], BLOB_SUBDIR, shard)
+    # 同一 md5 的原文件和缩略图归为一组：<md5>.png、<md5>.sm.webp ...
+    groups = {}
+    if os.path.isdir(shard_dir):
+        with os.scandir(shard_dir) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    stat = entry.stat()
+                    groups.setdefault(entry.name.split('.', 1)[0], []).append((entry.name, stat.st_size, stat.st_mtime))
+    # 宽限期从最近一次被使用算起：刚被上传复用、还没建立笔记的 blob 不能回收
+    expired_clause = func.coalesce(Blob.last_seen, Blob.created_at) < cutoff
+    rows = db.session.query(Blob.md5, Blob.path, Blob.ref_count, expired_clause.label('expired')) \
+        .filter(md5_prefix_range(Blob.md5, shard)).all()
+
+    expired = {}
+    for row in rows:
+        files = groups.pop(row.md5, [])
+        if row.ref_count <= 0 and row.expired:
+            # 放弃的画廊上传，或删除时没删干净的文件
+            expired[row.md5] = files
+        elif row.ref_count > 0 and os.path.basename(row.path) not in {name for name, _, _ in files}:
+            report['missing'] += 1
+            logger.warning(f"Blob {row.md5} is referenced but {row.path} is missing")
+
+    md5_digests = list(expired)
+    batch_size = app.config['STORAGE_GC_BATCH']
+    for start in range(0, len(md5_digests), batch_size):
+        chunk = md5_digests[start:start + batch_size]
+        if not dry_run:
+            # 先删记录（仍要求 ref_count <= 0），并发的 acquire_blob 因此不会拿到即将删除的文件
+            Blob.query.filter(Blob.md5.in_(chunk), Blob.ref_count <= 0, expired_clause) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+            kept = {md5 for (md5,) in db.session.query(Blob.md5).filter(Blob.md5.in_(chunk))}
+            chunk = [md5 for md5 in chunk if md5 not in kept]
+        report['blob_rows'] += len(chunk)
+        reclaim_files([(os.path.join(shard_dir, name), size) for md5 in chunk for name, size, _ in expired[md5]],
+                      report, dry_run)
+
+    # 没有记录的文件：存入时中断、删除记录后删文件失败等
+    cutoff_ts = cutoff.timestamp()
+    reclaim_files([(os.path.join(shard_dir, name), size) for files in groups.values()
+                   if all(mtime < cutoff_ts for _, _, mtime in files) for name, size, _ in files], report, dry_run)
+
+
+def legacy_file_references():
+    """Paths outside the blob store still referenced by notes, read in keyset batches of note ids."""
+    batch_size = app.config['STORAGE_GC_BATCH']
+    prefix = f'{BLOB_SUBDIR}/'
+    references = {path for (path,) in db.session.query(NoteItem.path).filter(~NoteItem.path.startswith(prefix))}
+    last_id = 0
+    while True:
+        notes = db.session.query(Note.id, Note.content_type, Note.status, Note.item_count, Note.content_data,
+                                 Note.raw_content) \
+            .filter(Note.id > last_id, ~Note.content_data.startswith(prefix),
+                    db.or_(Note.content_type.in_(['image', 'file']),
+                           db.and_(Note.content_type.in_(['gallery', 'zip']), Note.item_count.is_(None)))) \
+            .order_by(Note.id).limit(batch_size).all()
+        if not notes:
+            return references
+        for note in notes:
+            references.update(note_file_paths(note))
+        last_id = notes[-1].id
+
+
+def gc_legacy_files(cutoff, report, dry_run=False):
+    """Flat files in UPLOAD_FOLDER from before the blob store are kept while a note references them."""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    cutoff_ts = cutoff.timestamp()
+    candidates = {}
+    with os.scandir(upload_folder) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False) and not entry.name.startswith('.'):
+                stat = entry.stat()
+                candidates[entry.name] = (stat.st_size, stat.st_mtime)
+    if not candidates:
+        return
+    references = legacy_file_references()
+    report['missing'] += len({path for path in references if '/' not in path} - candidates.keys())
+    stems = {os.path.splitext(path)[0] for path in references}
+    thumbnail_suffixes = [f".{size}.{app.config['THUMBNAIL_FORMAT']}" for size in app.config['THUMBNAIL_SIZES']]
+    orphans = []
+    for name, (size, mtime) in candidates.items():
+        if name in references or mtime >= cutoff_ts:
+            continue
+        if any(name.endswith(suffix) and name[:-len(suffix)] in stems for suffix in thumbnail_suffixes):
+            continue
+        orphans.append((os.path.join(upload_folder, name), size))
+    reclaim_files(orphans, report, dry_run)
+
+
+def collect_storage_garbage(steps=None, dry_run=False, throttle=None):
+    """
+    Reconcile the upload folder with the blob and note tables a few steps at a time (STORAGE_GC_STEPS),
+    resuming from the saved checkpoint, and pause after each step in proportion to its duration.
+    Deletes orphans older than STORAGE_GC_GRACE. Returns a Counter: files, bytes, blob_rows, missing, steps.
+    """
+    steps = steps or app.config['STORAGE_GC_STEPS_PER_RUN']
+    throttle = app.config['STORAGE_GC_THROTTLE'] if throttle is None else throttle
+    cutoff = datetime.now(timezone.utc) - app.config['STORAGE_GC_GRACE']
+    position = load_checkpoint('storage_gc', 0) % len(STORAGE_GC_STEPS)
+    report = Counter()
+    for _ in range(min(steps, len(STORAGE_GC_STEPS))):
+        started = time.monotonic()
+        step = STORAGE_GC_STEPS[position]
+        if step == 'legacy':
+            gc_legacy_files(cutoff, report, dry_run)
+        else:
+            gc_blob_shard(step, cutoff, report, dry_run)
+        position = (position + 1) % len(STORAGE_GC_STEPS)
+        if not dry_run:
+            save_checkpoint('storage_gc', position)
+        db.session.commit()
+        report['steps'] += 1
+        if throttle:
+            time.sleep(min((time.monotonic() - started) * throttle, 5))
+    return report
+
+
+@app.cli.command('gc-storage')
+@click.option('--dry-run', is_flag=True, help='只统计可回收的文件，不删除')
+def gc_storage_command(dry_run):
+    """Run one full storage GC round and report the space reclaimed."""
+    report = collect_storage_garbage(steps=len(STORAGE_GC_STEPS), dry_run=dry_run, throttle=0)
+    print(f"{'可回收' if dry_run else '已回收'} {report['files']} 个文件，共 {report['bytes'] / 1024 / 1024:.1f} MB；"
+          f"无引用记录 {report['blob_rows']} 条；缺失文件 {report['missing']} 个")
+
+
+def retention_tiers():
+    """(checkpoint key, retention days, User filter) for every retention period in use."""
+    tiers = []
+    if app.config['NOTE_RETENTION_DAYS']:
+        tiers.append(('default', app.config['NOTE_RETENTION_DAYS'], User.retention_days.is_(None)))
+    for (days,) in db.session.query(User.retention_days).filter(User.retention_days > 0).distinct():
+        tiers.append((str(days), days, User.retention_days == days))
+    return tiers
+
+
+def expired_note_batch(days, user_filter, after, batch_size):
+    """
+    The oldest batch_size notes of one tier older than `days`, as (id, user_id, timestamp). Walks
+    ix_note_timestamp from the checkpoint `after` = (timestamp, id), skipping notes of other tiers already passed.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    query = db.session.query(Note.id, Note.user_id, Note.timestamp).join(User, User.id == Note.user_id) \
+        .filter(Note.timestamp < cutoff, user_filter)
+    if after:
+        query = query.filter(Note.timestamp >= after[0], tuple_(Note.timestamp, Note.id) > tuple_(*after))
+    return query.order_by(Note.timestamp, Note.id).limit(batch_size).all()
+
+
+def enforce_retention(max_batches=None, throttle=None):
+    """
+    Delete notes older than their owner's retention period, RETENTION_BATCH per transaction and oldest
+    first within each tier, pausing after each batch in proportion to its duration. Files go to
+    purge_files jobs. Progress per tier is checkpointed, so a large backlog is worked off over several
+    runs. Returns the number of notes deleted.
+    """
+    batch_size = app.config['RETENTION_BATCH']
+    max_batches = max_batches or app.config['RETENTION_BATCHES_PER_RUN']
+    throttle = app.config['RETENTION_THROTTLE'] if throttle is None else throttle
+    checkpoints = load_checkpoint('retention', {})
+    deleted = batches = 0
+    for key, days, user_filter in retention_tiers():
+        while batches < max_batches:
+            started = time.monotonic()
+            after = checkpoints.get(key)
+            notes = expired_note_batch(days, user_filter, after and (datetime.fromisoformat(after[0]), after[1]),
+                                       batch_size)
+            if not notes:
+                # 本轮已扫完；下一轮从头开始，期间缩短了保留期的用户的旧笔记也会被处理
+                if checkpoints.pop(key, None) is not None:
+                    save_checkpoint('retention', checkpoints)
+                    db.session.commit()
+                break
+            note_ids = {}
+            for note in notes:
+                note_ids.setdefault(note.user_id, []).append(note.id)
+            purges = []
+            for user_id, ids in note_ids.items():
+                count, released_blobs, legacy_paths = delete_user_notes(user_id, ids)
+                deleted += count
+                purges.append((user_id, released_blobs, legacy_paths))
+            checkpoints[key] = [notes[-1].timestamp.isoformat(), notes[-1].id]
+            save_checkpoint('retention', checkpoints)
+            # 第一次调用提交删除和进度；若之后中断，未入队的文件引用已释放，由存储回收清理
+            for user_id, released_blobs, legacy_paths in purges:
+                queue_file_purge(user_id, released_blobs, legacy_paths)
+            batches += 1
+            if throttle:
+                time.sleep(min((time.monotonic() - started) * throttle, 5))
+    return deleted
+
+
+@app.cli.command('enforce-retention')
+def enforce_retention_command():
+    """Delete every note past its retention period."""
+    total = 0
+    while True:
+        deleted = enforce_retention(throttle=0)
+        if not deleted:
+            break
+        total += deleted
+    print(f"已删除 {total} 条过期笔记")
+
+
+def upload_reaper_loop():
+    while True:
+        time.sleep(app.config['UPLOAD_REAPER_INTERVAL'])
+        with app.app_context():
+            try:
+                reap_upload_sessions()
+                reap_jobs()
+                reconcile_usage(max_age=app.config['USAGE_RECONCILE_INTERVAL'])
+                expired = enforce_retention()
+                if expired:
+                    logger.info(f"Retention: deleted {expired} expired notes")
+                gc_report = collect_storage_garbage()
+                if gc_report['files'] or gc_report['blob_rows'] or gc_report['missing']:
+                    logger.info(f"Storage GC: {dict(gc_report)}")
+                logger.info(f"User cache: {user_cache.stats()}")
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Upload reaper failed: {str(e)}")
+
+
+class JobFailed(Exception):
+    """Raised by a job handler for errors that retrying cannot fix; the message is shown to the user."""
+
+
+# kind -> (handler(job, payload) -> result dict, on_failure(job, payload) or None)
+JOB_HANDLERS = {}
+job_wakeup = threading.Event()
+
+
+def enqueue_job(kind, payload, user_id, note_id=None):
+    """
+    Queue a job and commit. Without running workers (tests, one-off scripts) the job is run
+    inline, so callers always get a job whose status may already be final.
+    """
+    job = Job(kind=kind, payload=json.dumps(payload), user_id=user_id, note_id=note_id)
+    db.session.add(job)
+    db.session.commit()
+    if background_workers_started:
+        job_wakeup.set()
+    else:
+        run_job(job.id)
+    return job
+
+
+def run_job(job_id):
+    """Claim and run one pending job; returns False if another worker got it first."""
+    claimed = Job.query.filter_by(id=job_id, status='pending').update(
+        {'status': 'running', 'attempts': Job.attempts + 1, 'updated_at': datetime.now(timezone.utc)})
+    db.session.commit()
+    if not claimed:
+        return False
+    job = db.session.get(Job, job_id)
+    handler, on_failure = JOB_HANDLERS[job.kind]
+    payload = json.loads(job.payload)
     try:
-        chunk.save(chunk_path)
+        result = handler(job, payload)
+        job.status = 'done'
+        job.result = json.dumps(result or {})
     except Exception as e:
-        shutil.rmtree(chunk_dir, ignore_errors=True)
-        return jsonify({'success': False, 'error': f'保存分片失败: {str(e)}'}), 500
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        permanent = isinstance(e, JobFailed) or job.attempts >= app.config['JOB_MAX_ATTEMPTS']
+        if not permanent:
+            logger.warning(f"Job {job_id} ({job.kind}) failed, will retry: {str(e)}")
+            job.status = 'pending'
+        else:
+            if not isinstance(e, JobFailed):
+                logger.error(f"Job {job_id} ({job.kind}) failed after {job.attempts} attempts: {str(e)}")
+            job.status = 'failed'
+            job.error = str(e) if isinstance(e, JobFailed) else '后台处理失败，请重新上传'
+            if on_failure:
+                on_failure(job, payload)
+    job.updated_at = datetime.now(timezone.utc)
+    db.session.commit()
+    return True
 
-    if chunk_index == total_chunks - 1:
-        safe_filename = secure_filename(filename)
-        final_path = os.path.join(app.config['UPLOAD_FOLDER'], safe_filename)
-        file_size = 0
-        md5_hash = hashlib.md5()
-        try:
-            with open(final_path, 'wb') as f:
-                for i in range(total_chunks):
-                    chunk_file = os.path.join(chunk_dir, f'chunk-{i}')
-                    with open(chunk_file, 'rb') as cf:
-                        chunk_data = cf.read()
-                        f.write(chunk_data)
-                        md5_hash.update(chunk_data)
-                        file_size += len(chunk_data)
-        except Exception as e:
-            shutil.rmtree(chunk_dir, ignore_errors=True)
-            if os.path.exists(final_path): os.remove(final_path)
-            return jsonify({'success': False, 'error': f'合并分片失败: {str(e)}'}), 500
-
-        with open(final_path, 'rb') as f:
-            file_header = f.read(2048)
-            if not allowed_file(filename, file_header):
-                os.remove(final_path)
-                shutil.rmtree(chunk_dir)
-                return jsonify({'success': False, 'error': '不支持的文件类型'}), 400
 
-        md5_digest = md5_hash.hexdigest()
-        existing_note = Note.query.filter_by(user_id=user_id, md5=md5_digest).first()
-        if existing_note:
-            os.remove(final_path)
-            shutil.rmtree(chunk_dir)
-            return jsonify({'success': False, 'error': '文件已存在，无需重复上传'}), 409
+def job_worker_loop():
+    while True:
+        job_wakeup.wait(app.config['JOB_POLL_INTERVAL'])
+        job_wakeup.clear()
+        with app.app_context():
+            try:
+                while True:
+                    next_job = db.session.query(Job.id).filter_by(status='pending').order_by(Job.id).first()
+                    if next_job is None:
+                        break
+                    run_job(next_job.id)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Job worker failed: {str(e)}")
+
+
+def reap_jobs():
+    """Requeue jobs orphaned by a dead worker and forget finished jobs nobody will poll anymore."""
+    now = datetime.now(timezone.utc)
+    requeued = Job.query.filter(Job.status == 'running', Job.updated_at < now - app.config['JOB_TIMEOUT']) \
+        .update({'status': 'pending'}, synchronize_session=False)
+    Job.query.filter(Job.status.in_(['done', 'failed']), Job.updated_at < now - app.config['JOB_RETENTION']) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    if requeued:
+        logger.warning(f"Requeued {requeued} stalled jobs")
+        job_wakeup.set()
+
+
+background_workers_started = False
+background_workers_lock = threading.Lock()
+
+
+def start_background_workers():
+    """Start the per-process daemon threads exactly once."""
+    global background_workers_started
+    with background_workers_lock:
+        if background_workers_started:
+            return
+        background_workers_started = True
+    threading.Thread(target=upload_reaper_loop, name='upload-reaper', daemon=True).start()
+    threading.Thread(target=share_view_flush_loop, name='share-view-flush', daemon=True).start()
+    atexit.register(flush_share_views_on_exit)
+    for i in range(app.config['JOB_WORKERS']):
+        threading.Thread(target=job_worker_loop, name=f'job-worker-{i}', daemon=True).start()
+    job_wakeup.set()
+
+
+@app.before_request
+def ensure_background_workers():
+    if not background_workers_started and not app.config.get('TESTING'):
+        start_background_workers()
+
+
+def upload_content_type(filename):
+    return 'image' if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')) else 'file'
+
+
+def note_json(note):
+    """The note shape the notes page script renders."""
+    item_count = None
+    if note.content_type == 'text':
+        content = note.content_data
+    elif note.content_type in ['gallery', 'zip']:
+        content = None
+        item_count = note_item_count(note)
+    else:
+        content = url_for('uploaded_file', filename=note.content_data) if note.status == 'ready' else None
+    return {
+        'id': note.id,
+        'type': note.content_type,
+        'content': content,
+        'raw_content': note.raw_content,
+        'additional_text': note.additional_text,
+        'timestamp': note.timestamp.isoformat(),
+        'file_size': note.file_size,
+        'md5': note.md5,
+        'status': note.status,
+        'item_count': item_count,
+        'thumbnails': {size: url_for('thumbnail', size=size, filename=note.content_data)
+                       for size in app.config['THUMBNAIL_SIZES']}
+        if note.content_type == 'image' and note.status == 'ready' else None
+    }
+
+
+def file_upload_response(user_id, filename, blob, mode, additional_text):
+    """Answer a completed upload: gallery members go back to the client, anything else becomes a note."""
+    if mode == 'gallery':
+        return jsonify({
+            'success': True,
+            'content': blob.path,
+            'file_size': blob.size,
+            'md5': blob.md5,
+            'raw_content': filename
+        })
 
-        base, ext = os.path.splitext(safe_filename)
-        final_filename_with_hash = f"{base}_{md5_digest}{ext}"
-        final_path_with_hash = os.path.join(app.config['UPLOAD_FOLDER'], final_filename_with_hash)
-        os.rename(final_path, final_path_with_hash)
-        safe_filename = final_filename_with_hash
-
-        if mode == 'gallery':
-            shutil.rmtree(chunk_dir)
-            return jsonify({
-                'success': True,
-                'content': safe_filename,
-                'file_size': file_size,
-                'md5': md5_digest,
-                'raw_content': filename
-            })
-
-        content_type = 'image' if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif')) else 'file'
-        new_note = Note(
+    new_note = Note(
+        user_id=user_id,
+        content_type=upload_content_type(filename),
+        content_data=blob.path,
+        raw_content=filename,
+        additional_text=additional_text or None,
+        file_size=blob.size,
+        md5=blob.md5,
+        timestamp=datetime.now(timezone.utc)
+    )
+    try:
+        db.session.add(new_note)
+        if not acquire_blob(blob.md5):
+            db.session.rollback()
+            return jsonify({'success': False, 'error': '文件已失效，请重新上传'}), 409
+        db.session.flush()
+        index_note(new_note)
+        adjust_usage(new_note.user_id, 1, new_note.file_size)
+        db.session.commit()
+        return jsonify({'success': True, 'note': note_json(new_note)})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': f'数据库错误: {str(e)}'}), 500
+
+
+def queue_upload(user_id, staged_path, filename, md5_digest, file_size, mode, additional_text):
+    """
+    Hand a fully received file (in TEMP_CHUNK_DIR) to the job queue and commit.
+    Non-gallery uploads get a pending note right away; the worker fills it in.
+    """
+    note_id = None
+    if mode != 'gallery':
+        note = Note(
             user_id=user_id,
-            content_type=content_type,
-            content_data=safe_filename,
+            content_type=upload_content_type(filename),
+            content_data='',
             raw_content=filename,
             additional_text=additional_text or None,
             file_size=file_size,
             md5=md5_digest,
+            status='pending',
             timestamp=datetime.now(timezone.utc)
         )
-        try:
-            db.session.add(new_note)
+        db.session.add(note)
+        db.session.flush()
+        index_note(note)
+        adjust_usage(user_id, 1, file_size)
+        note_id = note.id
+    payload = {'path': os.path.basename(staged_path), 'filename': filename, 'md5': md5_digest,
+               'file_size': file_size, 'mode': mode}
+    return job_response(enqueue_job('process_upload', payload, user_id, note_id))
+
+
+def process_upload_job(job, payload):
+    """Sniff the staged file, move it into the blob store and publish the pending note."""
+    staged_path = os.path.join(app.config['TEMP_CHUNK_DIR'], payload['path'])
+    filename = payload['filename']
+    if os.path.exists(staged_path):
+        if not allowed_file(filename, read_header(staged_path)):
+            raise JobFailed('不支持的文件类型')
+        blob = store_blob(staged_path, payload['md5'], payload['file_size'], filename)
+        if os.path.splitext(blob.path)[1] in THUMBNAIL_SOURCE_EXTENSIONS:
+            try:
+                ensure_thumbnails(blob.path)
+            except Exception as e:
+                # 缩略图失败不影响上传，访问时会再尝试生成
+                logger.warning(f"Thumbnail generation failed for {blob.path}: {str(e)}")
+    else:
+        # 上一次尝试可能已经把文件移入存储
+        blob = db.session.get(Blob, payload['md5'])
+        if blob is None:
+            raise JobFailed('上传的文件已丢失，请重新上传')
+
+    if payload['mode'] == 'gallery':
+        return {'content': blob.path, 'file_size': blob.size, 'md5': blob.md5, 'raw_content': filename}
+    # 笔记 id 可能在删除后被复用：只认本任务用户的待处理笔记
+    note = Note.query.filter_by(id=job.note_id, user_id=job.user_id, status='pending').first() \
+        if job.note_id else None
+    if note is None:
+        return {}  # 处理期间笔记已被删除
+    if not acquire_blob(blob.md5):
+        raise JobFailed('文件已失效，请重新上传')
+    note.content_data = blob.path
+    note.status = 'ready'
+    return {}
+
+
+def discard_failed_upload(job, payload):
+    staged_path = os.path.join(app.config['TEMP_CHUNK_DIR'], payload['path'])
+    if os.path.exists(staged_path):
+        os.remove(staged_path)
+    note = Note.query.filter_by(id=job.note_id, user_id=job.user_id, status='pending').first() \
+        if job.note_id else None
+    if note:
+        adjust_usage(note.user_id, -1, -(note.file_size or 0))
+        unindex_notes([note.id])
+        unshare_notes([note.id])
+        db.session.delete(note)
+
+
+JOB_HANDLERS['process_upload'] = (process_upload_job, discard_failed_upload)
+
+
+def queue_file_purge(user_id, released_blobs, legacy_paths):
+    """
+    Commit the current transaction together with a purge_files job for the files it released,
+    so unlinking thousands of files happens on a worker instead of the request thread.
+    """
+    if not released_blobs and not legacy_paths:
+        db.session.commit()
+        return None
+    upload_folder = app.config['UPLOAD_FOLDER']
+    payload = {'blobs': released_blobs, 'paths': [os.path.relpath(path, upload_folder) for path in legacy_paths]}
+    return enqueue_job('purge_files', payload, user_id)
+
+
+def purge_files_job(job, payload):
+    """Unlink the released files; blob reference counts are re-checked, so a retry is harmless."""
+    for path in payload['paths']:
+        remove_stored_file(os.path.join(app.config['UPLOAD_FOLDER'], path))
+    purge_unreferenced_blobs(payload['blobs'])
+    return {}
+
+
+JOB_HANDLERS['purge_files'] = (purge_files_job, None)
+
+
+def job_response(job):
+    """Report a job to the client; gallery uploads carry their file info, others the (possibly pending) note."""
+    if job.status == 'failed':
+        return jsonify({'success': False, 'job_id': job.id, 'status': job.status, 'error': job.error}), 400
+    body = {'success': True, 'job_id': job.id, 'status': job.status}
+    if job.status == 'done':
+        body.update(json.loads(job.result))
+    if job.note_id:
+        note = Note.query.filter_by(id=job.note_id, user_id=job.user_id).first()
+        if note is None:
+            return jsonify({'success': False, 'job_id': job.id, 'error': '笔记已被删除'}), 404
+        body['note'] = note_json(note)
+    elif job.kind == 'process_upload' and json.loads(job.payload)['mode'] != 'gallery':
+        # 删除笔记时任务的 note_id 会被清空
+        return jsonify({'success': False, 'job_id': job.id, 'error': '笔记已被删除'}), 404
+    return jsonify(body)
+
+
+@app.route('/notes/jobs/<int:job_id>')
+@login_required
+@read_only_db
+def job_status(job_id):
+    job = db.session.get(Job, job_id)
+    if job is None or job.user_id != current_user.id:
+        return jsonify({'success': False, 'error': '任务不存在'}), 404
+    return job_response(job)
+
+
+def challenge_serializer():
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='upload-challenge')
+
+
+def possession_challenge(user_id, md5_digest, file_size, nonce):
+    """
+    The byte range a client must hash to prove it holds the file, not just its MD5.
+    Seeded per user and per challenge, so a proof cannot be replayed or handed to someone else.
+    """
+    length = min(INSTANT_UPLOAD_PROOF_SIZE, file_size)
+    seed = hmac.new(app.config['SECRET_KEY'].encode(), f'{user_id}:{md5_digest}:{file_size}:{nonce}'.encode(),
+                    hashlib.sha256)
+    offset = int(seed.hexdigest(), 16) % (file_size - length + 1)
+    return offset, length
+
+
+def issue_possession_challenge(user_id, md5_digest, file_size):
+    """
+    A fresh challenge: (token, offset, length). The signed, expiring token carries the nonce,
+    so the server needs no state between the two handshake calls.
+    """
+    nonce = secrets.token_urlsafe(16)
+    token = challenge_serializer().dumps({'user_id': user_id, 'md5': md5_digest, 'file_size': file_size,
+                                          'nonce': nonce})
+    return (token,) + possession_challenge(user_id, md5_digest, file_size, nonce)
+
+
+def redeem_possession_challenge(token, user_id, md5_digest, file_size):
+    """The (offset, length) a challenge token was issued for, or None if forged, expired or for another user/file."""
+    try:
+        claims = challenge_serializer().loads(token, max_age=INSTANT_UPLOAD_CHALLENGE_TTL)
+    except BadSignature:
+        return None
+    if not isinstance(claims, dict) or (claims.get('user_id'), claims.get('md5'), claims.get('file_size')) \
+            != (user_id, md5_digest, file_size):
+        return None
+    return possession_challenge(user_id, md5_digest, file_size, claims.get('nonce'))
+
+
+@app.route('/notes/upload_check', methods=['POST'])
+@login_required
+def upload_check():
+    """
+    Hash-first handshake before a chunked upload.
+    - status 'exists': the user already has this file.
+    - status 'challenge': the content is stored; hash bytes [offset, offset+length) and call again with `proof`
+      and the returned `challenge_token` (valid for INSTANT_UPLOAD_CHALLENGE_TTL seconds).
+    - status 'stored': proof accepted, the upload was completed without transferring the file.
+    - status 'upload': unknown content, send the chunks.
+    """
+    user_id = current_user.id
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename')
+    md5_digest = str(data.get('md5', '')).lower()
+    mode = data.get('mode', 'file')
+    additional_text = (data.get('additional_text') or '').strip()
+    try:
+        file_size = int(data.get('file_size', -1))
+    except (TypeError, ValueError):
+        file_size = -1
+    if not filename or file_size <= 0 or len(md5_digest) != 32 \
+            or any(c not in '0123456789abcdef' for c in md5_digest):
+        return jsonify({'success': False, 'error': '无效的请求数据'}), 400
+    if os.path.splitext(filename)[1].lower() not in ALLOWED_EXTENSIONS:
+        return jsonify({'success': False, 'error': '不支持的文件类型'}), 400
+
+    if mode != 'gallery' and Note.query.filter_by(user_id=user_id, md5=md5_digest).first():
+        return jsonify({'success': False, 'status': 'exists', 'error': '文件已存在，无需重复上传'}), 409
+    quota_error = storage_quota_error(user_id, file_size)
+    if quota_error:
+        return quota_error
+
+    blob = db.session.get(Blob, md5_digest)
+    src_path = os.path.join(app.config['UPLOAD_FOLDER'], blob.path) if blob else None
+    if not blob or blob.size != file_size or not os.path.isfile(src_path):
+        return jsonify({'success': True, 'status': 'upload'})
+
+    proof = data.get('proof')
+    if not proof:
+        token, offset, length = issue_possession_challenge(user_id, md5_digest, file_size)
+        return jsonify({'success': True, 'status': 'challenge', 'offset': offset, 'length': length,
+                        'challenge_token': token})
+    challenge = redeem_possession_challenge(str(data.get('challenge_token', '')), user_id, md5_digest, file_size)
+    if challenge is None:
+        return jsonify({'success': True, 'status': 'upload'})
+    offset, length = challenge
+
+    range_md5 = hashlib.md5()
+    with open(src_path, 'rb') as f:
+        f.seek(offset)
+        range_md5.update(f.read(length))
+        f.seek(0)
+        file_header = f.read(2048)
+    if not hmac.compare_digest(str(proof).lower(), range_md5.hexdigest()):
+        return jsonify({'success': True, 'status': 'upload'})
+    if not allowed_file(filename, file_header):
+        return jsonify({'success': False, 'error': '不支持的文件类型'}), 400
+
+    if not touch_blob(blob.md5):
+        return jsonify({'success': True, 'status': 'upload'})
+    response = file_upload_response(user_id, filename, blob, mode, additional_text)
+    if isinstance(response, tuple):
+        return response
+    result = response.get_json()
+    result['status'] = 'stored'
+    return jsonify(result)
+
+
+def received_chunk_indices(session_id):
+    return [index for (index,) in db.session.query(UploadChunk.chunk_index)
+            .filter_by(session_id=session_id).order_by(UploadChunk.chunk_index)]
+
+
+@app.route('/notes/upload_status/<chunk_id>')
+@login_required
+@read_only_db
+def upload_status(chunk_id):
+    upload = db.session.get(UploadSession, upload_session_key(current_user.id, chunk_id))
+    if not upload:
+        return jsonify({'success': True, 'exists': False, 'received': [], 'bytes_received': 0})
+    return jsonify({
+        'success': True,
+        'exists': True,
+        'received': received_chunk_indices(upload.id),
+        'bytes_received': upload.bytes_received,
+        'file_size': upload.file_size,
+        'chunk_size': upload.chunk_size,
+        'total_chunks': upload.total_chunks
+    })
+
+
+@app.route('/notes/upload_init', methods=['POST'])
+@login_required
+def upload_init():
+    """
+    Open (or resume) an upload session. The server decides the chunk size and how many
+    chunks the client may send in parallel; chunks may then arrive in any order.
+    """
+    user_id = current_user.id
+    data = request.get_json(silent=True) or {}
+    chunk_id = data.get('chunk_id')
+    filename = data.get('filename')
+    mode = data.get('mode', 'file')
+    additional_text = (data.get('additional_text') or '').strip()
+    try:
+        file_size = int(data.get('file_size', -1))
+    except (TypeError, ValueError):
+        file_size = -1
+    if not filename or file_size <= 0 or not secure_filename(chunk_id or ''):
+        return jsonify({'success': False, 'error': '无效的请求数据'}), 400
+    if os.path.splitext(filename)[1].lower() not in ALLOWED_EXTENSIONS:
+        return jsonify({'success': False, 'error': '不支持的文件类型'}), 400
+    if file_size > app.config['MAX_UPLOAD_SIZE']:
+        return jsonify({'success': False, 'error': '文件过大'}), 400
+    quota_error = storage_quota_error(user_id, file_size)
+    if quota_error:
+        return quota_error
+
+    session_key = upload_session_key(user_id, chunk_id)
+    upload = db.session.get(UploadSession, session_key)
+    try:
+        if upload and (upload.file_size != file_size or upload.status != 'uploading'):
+            drop_upload_session(upload)
             db.session.commit()
-            shutil.rmtree(chunk_dir)
-            return jsonify({
-                'success': True,
-                'note': {
-                    'id': new_note.id,
-                    'type': new_note.content_type,
-                    'content': url_for('uploaded_file', filename=new_note.content_data),
-                    'raw_content': new_note.raw_content,
-                    'additional_text': new_note.additional_text,
-                    'timestamp': new_note.timestamp.isoformat(),
-                    'file_size': new_note.file_size,
-                    'md5': new_note.md5
-                }
-            })
-        except Exception as e:
-            db.session.rollback()
-            if os.path.exists(final_path_with_hash): os.remove(final_path_with_hash)
-            return jsonify({'success': False, 'error': f'数据库保存失败: {str(e)}'}), 500
+            upload = None
+        if upload is None:
+            chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+            upload = UploadSession(id=session_key, user_id=user_id, filename=filename, file_size=file_size,
+                                   chunk_size=chunk_size, total_chunks=(file_size + chunk_size - 1) // chunk_size)
+            db.session.add(upload)
+        upload.mode = mode
+        upload.additional_text = additional_text or None
+        upload.updated_at = datetime.now(timezone.utc)
+        db.session.commit()
+        get_chunk_assembly(upload)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': f'创建上传会话失败: {str(e)}'}), 500
+
+    return jsonify({
+        'success': True,
+        'chunk_id': chunk_id,
+        'chunk_size': upload.chunk_size,
+        'total_chunks': upload.total_chunks,
+        'max_concurrency': app.config['UPLOAD_MAX_CONCURRENCY'],
+        'received': received_chunk_indices(upload.id),
+        'bytes_received': upload.bytes_received
+    })
+
+
+def legacy_upload_session(user_id, session_key):
+    """Sessions for clients that still send chunkSize/fileSize with every chunk instead of calling upload_init."""
+    try:
+        total_chunks = int(request.form.get('totalChunks', -1))
+        chunk_size = int(request.form.get('chunkSize', -1))
+        file_size = int(request.form.get('fileSize', -1))
+    except ValueError:
+        return None
+    filename = request.form.get('filename')
+    if not filename or chunk_size <= 0 or file_size <= 0 or total_chunks <= 0 \
+            or (total_chunks - 1) * chunk_size >= file_size or total_chunks * chunk_size < file_size \
+            or file_size > app.config['MAX_UPLOAD_SIZE']:
+        return None
+    upload = UploadSession(id=session_key, user_id=user_id, filename=filename, file_size=file_size,
+                           chunk_size=chunk_size, total_chunks=total_chunks,
+                           mode=request.form.get('mode', 'file'),
+                           additional_text=request.form.get('additional_text', '').strip() or None)
+    db.session.add(upload)
+    db.session.commit()
+    return upload
+
+
+@app.route('/notes/upload_chunk', methods=['POST'])
+@login_required
+def upload_chunk():
+    user_id = current_user.id
+    chunk = request.files.get('chunk')
+    chunk_index = int(request.form.get('chunkIndex', -1))
+    chunk_id = request.form.get('chunkId')
 
-    return jsonify({'success': True, 'message': '分片上传成功'})
+    if not chunk or chunk_index < 0 or not secure_filename(chunk_id or ''):
+        return jsonify({'success': False, 'error': '缺少必要参数或参数无效'}), 400
+
+    session_key = upload_session_key(user_id, chunk_id)
+    upload = db.session.get(UploadSession, session_key)
+    try:
+        if upload is None:
+            upload = legacy_upload_session(user_id, session_key)
+            if upload is None:
+                return jsonify({'success': False, 'error': '上传会话不存在，请重新上传'}), 404
+        if upload.status != 'uploading' or chunk_index >= upload.total_chunks:
+            return jsonify({'success': False, 'error': '上传会话不匹配'}), 409
+        assembly = get_chunk_assembly(upload)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': f'创建上传会话失败: {str(e)}'}), 500
+    total_chunks = upload.total_chunks
+
+    try:
+        written = assembly.write_chunk(chunk_index, chunk.stream)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': f'分片无效: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'保存分片失败: {str(e)}'}), 500
+
+    try:
+        # 分片落盘后才记录，状态查询返回的分片一定是完整的
+        if not UploadChunk.query.filter_by(session_id=session_key, chunk_index=chunk_index).first():
+            db.session.add(UploadChunk(session_id=session_key, chunk_index=chunk_index, size=written))
+            UploadSession.query.filter_by(id=session_key).update(
+                {'bytes_received': UploadSession.bytes_received + written,
+                 'updated_at': datetime.now(timezone.utc)})
+        db.session.commit()
+    except IntegrityError:
+        # 同一分片的并发重试，另一个请求已经登记
+        db.session.rollback()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': f'记录分片失败: {str(e)}'}), 500
+
+    received_count = UploadChunk.query.filter_by(session_id=session_key).count()
+    if received_count < total_chunks:
+        return jsonify({'success': True, 'message': '分片上传成功', 'received': received_count})
+
+    # 分片可以乱序并行到达：只有一个请求能把会话从 uploading 切换到 finalizing
+    claimed = UploadSession.query.filter_by(id=session_key, status='uploading').update({'status': 'finalizing'})
+    db.session.commit()
+    if not claimed:
+        return jsonify({'success': True, 'message': '分片上传成功', 'received': received_count})
+    return finalize_upload(db.session.get(UploadSession, session_key), assembly)
+
+
+def finalize_upload(upload, assembly):
+    """All chunks are already in place: read the digest and queue the file for background processing."""
+    user_id = upload.user_id
+    filename = upload.filename
+    mode = upload.mode
+    additional_text = upload.additional_text or ''
+    assembly.sync_received(row.chunk_index for row in upload.chunks)
+    md5_digest = assembly.hexdigest()
+    file_size = upload.file_size
+
+    existing_note = Note.query.filter_by(user_id=user_id, md5=md5_digest).first()
+    if existing_note and mode != 'gallery':
+        drop_upload_session(upload)
+        db.session.commit()
+        return jsonify({'success': False, 'error': '文件已存在，无需重复上传'}), 409
+
+    # 换成唯一的文件名，同一 chunkId 重新开始的上传不会覆盖排队中的文件
+    staged_path = os.path.join(app.config['TEMP_CHUNK_DIR'], f'{upload.id}-{os.urandom(4).hex()}.staged')
+    try:
+        os.replace(upload.part_path, staged_path)
+        drop_upload_session(upload, discard_file=False)
+        return queue_upload(user_id, staged_path, filename, md5_digest, file_size, mode, additional_text)
+    except Exception as e:
+        db.session.rollback()
+        if os.path.exists(staged_path): os.remove(staged_path)
+        return jsonify({'success': False, 'error': f'合并分片失败: {str(e)}'}), 500
 
 
 @app.route('/notes/add_multiple', methods=['POST'])
@@ -414,18 +2375,34 @@ def add_multiple():
         return jsonify({'success': False, 'error': '不支持的模式'}), 400
 
     file_paths = [item['content'] for item in file_data]
+    blob_md5s = {blob.path: blob.md5 for blob in Blob.query.filter(Blob.path.in_(set(file_paths)))}
+    if len(blob_md5s) != len(set(file_paths)):
+        return jsonify({'success': False, 'error': '文件已失效，请重新上传'}), 400
+    quota_error = storage_quota_error(user_id, sum(item['file_size'] for item in file_data))
+    if quota_error:
+        return quota_error
     try:
         new_note = Note(
             user_id=user_id,
             content_type='gallery',
-            content_data=json.dumps(file_paths),
-            raw_content=json.dumps([item['raw_content'] for item in file_data]),
+            content_data='',  # 成员存放在 note_item 表
             additional_text=additional_text or None,
             file_size=sum(item['file_size'] for item in file_data),
             md5=hashlib.md5(''.join(item['md5'] for item in file_data).encode()).hexdigest(),
+            item_count=len(file_data),
             timestamp=datetime.now(timezone.utc)
         )
         db.session.add(new_note)
+        db.session.flush()
+        db.session.add_all(NoteItem(note_id=new_note.id, ordinal=i, path=item['content'], filename=item['raw_content'],
+                                    file_size=item['file_size'], md5=blob_md5s[item['content']])
+                           for i, item in enumerate(file_data))
+        for path, count in Counter(file_paths).items():
+            if not acquire_blob(blob_md5s[path], count):
+                db.session.rollback()
+                return jsonify({'success': False, 'error': '文件已失效，请重新上传'}), 400
+        index_note(new_note)
+        adjust_usage(user_id, 1, new_note.file_size)
         db.session.commit()
         return jsonify({
             'success': True,
@@ -433,6 +2410,7 @@ def add_multiple():
                 'id': new_note.id,
                 'type': 'gallery',
                 'content': file_paths,
+                'item_count': new_note.item_count,
                 'additional_text': new_note.additional_text,
                 'timestamp': new_note.timestamp.isoformat(),
                 'file_size': new_note.file_size,
@@ -463,6 +2441,7 @@ def edit_note(note_id):
 
     note.timestamp = datetime.now(timezone.utc)
     try:
+        index_note(note)
         db.session.commit()
         return jsonify({
             'success': True,
@@ -481,33 +2460,93 @@ def delete_note(note_id):
     if note.user_id != current_user.id:
         return jsonify({'success': False, 'error': '无权删除此笔记'}), 403
     try:
-        if note.content_type in ['image', 'file', 'zip', 'gallery']:
-            paths_to_delete = []
-            if note.content_type in ['zip', 'gallery']:
-                try:
-                    paths_to_delete.extend(json.loads(note.content_data))
-                except (json.JSONDecodeError, TypeError):
-                    logger.warning(f"Could not parse content_data for note {note_id}")
-            else:
-                paths_to_delete.append(note.content_data)
-
-            for path in paths_to_delete:
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
-                if os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                    except OSError as e:
-                        logger.warning(f"Failed to remove {file_path}: {e}")
-        db.session.delete(note)
-        db.session.commit()
-        return jsonify({'success': True})
+        _, released_blobs, legacy_paths = delete_user_notes(current_user.id, [note.id])
+        # 引用计数归零的文件由后台任务在提交之后删除
+        queue_file_purge(current_user.id, released_blobs, legacy_paths)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': f'数据库错误: {str(e)}'}), 500
+    return jsonify({'success': True})
+
+
+BULK_NOTE_TYPES = ['text', 'image', 'file', 'gallery', 'zip']
+
+
+def parse_filter_time(value):
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def bulk_note_filter(query, criteria):
+    """
+    Narrow a Note query by a bulk filter: type (one or a list), before/after (ISO timestamps),
+    or {"all": true} for every note. Raises ValueError for anything else, including an empty filter.
+    """
+    if not isinstance(criteria, dict) or not criteria or set(criteria) - {'type', 'before', 'after', 'all'}:
+        raise ValueError('invalid filter')
+    if criteria.get('all', True) is not True:
+        raise ValueError('invalid filter')
+    if 'type' in criteria:
+        types = criteria['type'] if isinstance(criteria['type'], list) else [criteria['type']]
+        if not types or any(t not in BULK_NOTE_TYPES for t in types):
+            raise ValueError('invalid type')
+        query = query.filter(Note.content_type.in_(types))
+    try:
+        if 'before' in criteria:
+            query = query.filter(Note.timestamp < parse_filter_time(criteria['before']))
+        if 'after' in criteria:
+            query = query.filter(Note.timestamp >= parse_filter_time(criteria['after']))
+    except TypeError as e:
+        raise ValueError('invalid time') from e
+    return query
+
+
+@app.route('/notes/bulk', methods=['POST'])
+@login_required
+def bulk_notes():
+    """
+    Apply one action to many notes in a single transaction:
+    {"action": "delete", "ids": [...]} or {"action": "delete", "filter": {...}} (see bulk_note_filter).
+    A filter handles at most BULK_MAX_NOTES notes per call and reports has_more for the rest.
+    """
+    data = request.get_json(silent=True) or {}
+    # 目前只有删除；标签、移动等操作有了对应的数据模型后再加入
+    if data.get('action') != 'delete':
+        return jsonify({'success': False, 'error': '不支持的批量操作'}), 400
+    limit = app.config['BULK_MAX_NOTES']
+    has_more = False
+    if 'ids' in data:
+        note_ids = data['ids']
+        if not isinstance(note_ids, list) or not all(type(note_id) is int for note_id in note_ids):
+            return jsonify({'success': False, 'error': '无效的笔记 ID 列表'}), 400
+        note_ids = list(dict.fromkeys(note_ids))
+        if len(note_ids) > limit:
+            return jsonify({'success': False, 'error': f'一次最多处理 {limit} 条笔记'}), 400
+    else:
+        try:
+            query = bulk_note_filter(db.session.query(Note.id).filter(Note.user_id == current_user.id),
+                                     data.get('filter'))
+        except ValueError:
+            return jsonify({'success': False, 'error': '无效的筛选条件'}), 400
+        note_ids = [note_id for (note_id,) in query.order_by(Note.id).limit(limit + 1)]
+        has_more = len(note_ids) > limit
+        note_ids = note_ids[:limit]
+
+    try:
+        deleted, released_blobs, legacy_paths = delete_user_notes(current_user.id, note_ids)
+        queue_file_purge(current_user.id, released_blobs, legacy_paths)
     except Exception as e:
         db.session.rollback()
+        logger.error(f"Bulk delete failed: {str(e)}")
         return jsonify({'success': False, 'error': f'数据库错误: {str(e)}'}), 500
+    return jsonify({'success': True, 'deleted': deleted, 'has_more': has_more})
 
 
 @app.route('/notes/download/<int:note_id>')
 @login_required
+@read_only_db
 def download_note(note_id):
     note = Note.query.get_or_404(note_id)
     if note.user_id != current_user.id:
@@ -519,17 +2558,99 @@ def download_note(note_id):
 
     try:
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], note.content_data)
-        if not os.path.exists(file_path):
+        if not os.path.isfile(file_path):
             flash('文件不存在', 'danger')
             return redirect(url_for('notes_page'))
-        return send_file(file_path, as_attachment=True, download_name=note.raw_content)
+        return send_stored_file(note.content_data, etag=note.md5,
+                                download_name=note.raw_content or os.path.basename(note.content_data))
     except Exception as e:
         flash('下载失败', 'danger')
         return redirect(url_for('notes_page'))
 
 
+class PublicAwareSessionInterface(SecureCookieSessionInterface):
+    """
+    Cookie sessions that leave publicly cacheable responses alone: no Set-Cookie and no Vary: Cookie,
+    so a shared cache keeps one copy of a shared page for every visitor instead of one per session.
+    """
+
+    def save_session(self, app, session, response):
+        if g.get('public_response'):
+            return
+        super().save_session(app, session, response)
+
+
+app.session_interface = PublicAwareSessionInterface()
+
+
+def public_response(response, max_age):
+    """Mark a response shared caches may keep for max_age seconds; it carries nothing from the visitor's session."""
+    g.public_response = True
+    response.cache_control.public = True
+    response.cache_control.no_cache = None
+    response.cache_control.max_age = max_age
+    return response
+
+
+def attachment_disposition(download_name):
+    ascii_name = download_name.encode('ascii', 'ignore').decode().replace('"', '') or 'download'
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(download_name)}"
+
+
+def send_stored_file(relpath, etag=None, immutable=False, download_name=None, public_max_age=None):
+    """
+    Serve a file under UPLOAD_FOLDER with a strong ETag (the content MD5 when known),
+    304 answers and byte ranges for seeking in media. With FILE_OFFLOAD set, Flask only
+    sends the headers and the front proxy streams the bytes (and handles Range itself).
+    public_max_age marks a publicly shared file that shared caches may keep for that long.
+    """
+    file_path = safe_join(app.config['UPLOAD_FOLDER'], relpath)
+    if file_path is None or not os.path.isfile(file_path):
+        raise NotFound()
+    offload = app.config['FILE_OFFLOAD']
+    if offload:
+        if etag and request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            mimetype = mimetypes.guess_type(download_name or relpath)[0] or 'application/octet-stream'
+            response = Response(mimetype=mimetype)
+            if offload == 'x-accel-redirect':
+                response.headers['X-Accel-Redirect'] = app.config['X_ACCEL_REDIRECT_PREFIX'] + quote(relpath)
+            else:
+                response.headers['X-Sendfile'] = file_path
+            if download_name:
+                response.headers['Content-Disposition'] = attachment_disposition(download_name)
+        if etag:
+            response.set_etag(etag)
+    else:
+        response = send_file(file_path, conditional=True, etag=etag or True,
+                             as_attachment=download_name is not None, download_name=download_name)
+
+    if public_max_age is not None:
+        # 分享链接的文件：CDN/代理可以缓存，时长不超过分享剩余的有效期
+        return public_response(response, public_max_age)
+    response.cache_control.public = False  # 需要登录才能访问，不让共享缓存保存
+    response.cache_control.private = True
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = app.config['IMMUTABLE_FILE_MAX_AGE']
+        response.cache_control.immutable = True
+    else:
+        # 每次用 ETag 向服务器确认，内容没变只返回 304
+        response.cache_control.no_cache = True
+    return response
+
+
+def zip_download_response(entries, download_name):
+    """Stream a ZIP of (file_path, arcname) pairs while it is being built; memory stays constant."""
+    response = Response(stream_zip(entries), mimetype='application/zip')
+    response.headers['Content-Disposition'] = attachment_disposition(download_name)
+    return response
+
+
 @app.route('/notes/download_gallery/<int:note_id>')
 @login_required
+@read_only_db
 def download_gallery(note_id):
     note = Note.query.get_or_404(note_id)
     if note.user_id != current_user.id:
@@ -538,28 +2659,19 @@ def download_gallery(note_id):
         return jsonify({'success': False, 'error': '仅画廊笔记支持一键下载'}), 400
 
     try:
-        file_paths = json.loads(note.content_data)
-        raw_contents = json.loads(note.raw_content) if note.raw_content else [os.path.basename(path) for path in
-                                                                              file_paths]
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for path, original_name in zip(file_paths, raw_contents):
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
-                if os.path.exists(file_path):
-                    zip_file.write(file_path, original_name)
-        zip_buffer.seek(0)
-        return send_file(
-            zip_buffer,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name=f'gallery_note_{note_id}.zip'
-        )
+        entries = []
+        for item in note_members(note):
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], item.path)
+            if os.path.exists(file_path):
+                entries.append((file_path, item.filename or os.path.basename(item.path)))
+        return zip_download_response(entries, f'gallery_note_{note_id}.zip')
     except Exception as e:
         return jsonify({'success': False, 'error': f'下载失败: {str(e)}'}), 500
 
 
 @app.route('/notes/download_zip/<int:note_id>')
 @login_required
+@read_only_db
 def download_zip(note_id):
     note = Note.query.get_or_404(note_id)
     if note.user_id != current_user.id:
@@ -568,42 +2680,279 @@ def download_zip(note_id):
         return jsonify({'success': False, 'error': '仅ZIP笔记支持一键下载'}), 400
 
     try:
-        file_paths = json.loads(note.content_data)
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for file in file_paths:
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], file)
-                if os.path.exists(file_path):
-                    zip_file.write(file_path, os.path.basename(file))
-        zip_buffer.seek(0)
+        entries = []
+        for item in note_members(note):
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], item.path)
+            if os.path.exists(file_path):
+                entries.append((file_path, item.filename or os.path.basename(item.path)))
         zip_filename = note.raw_content if note.raw_content else f"archive_{note_id}.zip"
-        return send_file(
-            zip_buffer,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name=zip_filename
-        )
+        return zip_download_response(entries, zip_filename)
     except Exception as e:
         return jsonify({'success': False, 'error': f'下载失败: {str(e)}'}), 500
 
 
+share_cache = TTLCache(app.config['SHARE_CACHE_TTL'], app.config['SHARE_CACHE_SIZE'])
+shared_page_cache = TTLCache(app.config['SHARED_PAGE_CACHE_TTL'], app.config['SHARED_PAGE_CACHE_SIZE'])
+share_views = CounterBuffer()
+SHARE_TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+
+
+class ResolvedShare:
+    """The parts of a note_share row a view needs; immutable, so one cached copy serves every thread."""
+    __slots__ = ('id', 'note_id', 'expires_at', 'version')
+
+    def __init__(self, share_id, note_id, expires_at, version):
+        self.id = share_id
+        self.note_id = note_id
+        self.expires_at = expires_at
+        self.version = version  # 解析时笔记的版本，分享页缓存的键
+
+    def max_age(self):
+        """Seconds a downstream cache may keep a response for this share: SHARED_PAGE_MAX_AGE, never past expiry."""
+        remaining = int((self.expires_at - datetime.now(timezone.utc)).total_seconds())
+        return max(0, min(app.config['SHARED_PAGE_MAX_AGE'], remaining))
+
+
+def resolve_share(token):
+    """
+    The active, unexpired share for token, or None. Each token (including unknown ones) is read from
+    note_share at most once per SHARE_CACHE_TTL per process; expiry is checked on every call.
+    """
+    if not SHARE_TOKEN_PATTERN.match(token):
+        return None
+    share = share_cache.get(token)
+    if share is None:
+        row = db.session.query(NoteShare.id, NoteShare.note_id, NoteShare.expires_at, Note.version) \
+            .join(Note, Note.id == NoteShare.note_id) \
+            .filter(NoteShare.share_token == token, NoteShare.is_active.is_(True)).first()
+        # 不存在的 token 也缓存（False），失效链接被反复访问时不会每次查库
+        share = ResolvedShare(row.id, row.note_id, row.expires_at.replace(tzinfo=timezone.utc), row.version) \
+            if row else False
+        share_cache.set(token, share)
+    if not share or share.expires_at <= datetime.now(timezone.utc):
+        return None
+    return share
+
+
+# 分享页上显示的字段；其中任何一个变化都会产生新版本
+NOTE_VERSIONED_COLUMNS = ('content_type', 'content_data', 'raw_content', 'additional_text', 'status', 'item_count',
+                          'timestamp')
+
+
+@event.listens_for(Note, 'before_update')
+def bump_note_version(mapper, connection, note):
+    """A visible change gives the note a new version, so cached shared pages of the old one stop matching."""
+    state = db.inspect(note)
+    if any(state.attrs[key].history.has_changes() for key in NOTE_VERSIONED_COLUMNS):
+        note.version = Note.version + 1
+        # 本进程内立即失效；其他进程在 SHARE_CACHE_TTL 内重新解析到新版本
+        for (token,) in connection.execute(db.select(NoteShare.share_token).where(NoteShare.note_id == note.id)):
+            share_cache.pop(token)
+
+
+def unshare_notes(note_ids):
+    """Delete the shares of notes being deleted, in the current transaction, and drop them from the cache."""
+    tokens = [token for (token,) in db.session.query(NoteShare.share_token).filter(NoteShare.note_id.in_(note_ids))]
+    if tokens:
+        NoteShare.query.filter(NoteShare.note_id.in_(note_ids)).delete(synchronize_session=False)
+        for token in tokens:
+            share_cache.pop(token)
+
+
+def flush_share_views():
+    """Write the buffered view counts with one executemany UPDATE; returns how many shares were updated."""
+    counts = share_views.drain()
+    if not counts:
+        return 0
+    try:
+        db.session.execute(NoteShare.__table__.update().where(NoteShare.id == bindparam('share_id'))
+                           .values(access_count=NoteShare.access_count + bindparam('views')),
+                           [{'share_id': share_id, 'views': views} for share_id, views in counts.items()])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        share_views.restore(counts)
+        raise
+    return len(counts)
+
+
+def share_view_flush_loop():
+    while True:
+        time.sleep(app.config['SHARE_VIEW_FLUSH_INTERVAL'])
+        with app.app_context():
+            try:
+                flush_share_views()
+            except Exception as e:
+                logger.error(f"Share view flush failed: {str(e)}")
+
+
+def flush_share_views_on_exit():
+    with app.app_context():
+        try:
+            flush_share_views()
+        except Exception as e:
+            logger.error(f"Share view flush failed: {str(e)}")
+
+
+def shared_note_or_404(token):
+    share = resolve_share(token)
+    note = db.session.get(Note, share.note_id) if share else None
+    if note is None:
+        raise NotFound()
+    return share, note
+
+
+@app.route('/notes/share/<int:note_id>', methods=['POST'])
+@login_required
+def share_note(note_id):
+    note = Note.query.get_or_404(note_id)
+    if note.user_id != current_user.id:
+        return jsonify({'success': False, 'error': '无权分享此笔记'}), 403
+    data = request.get_json(silent=True) or {}
+    days = data.get('days', app.config['SHARE_DEFAULT_DAYS'])
+    if type(days) is not int or not 1 <= days <= app.config['SHARE_MAX_DAYS']:
+        return jsonify({'success': False, 'error': f"有效期须为 1 到 {app.config['SHARE_MAX_DAYS']} 天"}), 400
+    share = NoteShare(note_id=note.id, user_id=current_user.id, share_token=secrets.token_urlsafe(32),
+                      expires_at=datetime.now(timezone.utc) + timedelta(days=days))
+    db.session.add(share)
+    db.session.commit()
+    return jsonify({'success': True, 'share_id': share.id,
+                    'share_url': url_for('view_shared', token=share.share_token, _external=True),
+                    'expires_at': share.expires_at.replace(tzinfo=timezone.utc).isoformat()})
+
+
+@app.route('/notes/my_shares')
+@login_required
+@read_only_db
+def my_shares():
+    rows = db.session.query(NoteShare, Note.content_type, Note.raw_content,
+                            func.substr(Note.content_data, 1, 50).label('preview')) \
+        .join(Note, Note.id == NoteShare.note_id).filter(NoteShare.user_id == current_user.id) \
+        .order_by(NoteShare.created_at.desc()).all()
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    shares = [{'share': share, 'content_type': content_type,
+               'title': preview if content_type == 'text' else (raw_content or content_type),
+               'views': share.access_count + share_views.pending(share.id),
+               'active': share.is_active and share.expires_at > now}
+              for share, content_type, raw_content, preview in rows]
+    return render_template('my_shares.html', shares=shares)
+
+
+@app.route('/notes/share/<int:share_id>/revoke', methods=['POST'])
+@login_required
+def revoke_share(share_id):
+    share = NoteShare.query.get_or_404(share_id)
+    if share.user_id != current_user.id:
+        return jsonify({'success': False, 'error': '无权撤销此分享'}), 403
+    share.is_active = False
+    db.session.commit()
+    share_cache.pop(share.share_token)
+    return jsonify({'success': True})
+
+
+def render_shared_page(token, share):
+    """The rendered page for one version of a shared note, cached until the version changes or the share expires."""
+    key = (token, share.version)
+    page = shared_page_cache.get(key)
+    if page is None:
+        note = db.session.get(Note, share.note_id)
+        if note is None:
+            raise NotFound()
+        members = note_members(note) if note.content_type in ['gallery', 'zip'] else []
+        # 模板不含登录用户和 CSRF 信息，同一版本对所有访问者都相同
+        page = render_template('shared_note.html', note=note, token=token, members=members,
+                               expires_at=share.expires_at)
+        remaining = (share.expires_at - datetime.now(timezone.utc)).total_seconds()
+        shared_page_cache.set(key, page, ttl=min(app.config['SHARED_PAGE_CACHE_TTL'], remaining))
+    return page
+
+
+@app.route('/shared/<token>')
+@read_only_db
+def view_shared(token):
+    """
+    Public view of a shared note. The ETag is the share plus note version, so a client or CDN revalidates
+    to a 304 until the note changes; downstream caches keep it for at most SHARED_PAGE_MAX_AGE, and views
+    they absorb are not counted.
+    """
+    share = resolve_share(token)
+    if share is None:
+        raise NotFound()
+    share_views.add(share.id)
+    etag = f'share-{share.id}-v{share.version}'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = make_response(render_shared_page(token, share))
+    response.set_etag(etag)
+    return public_response(response, share.max_age())
+
+
+@app.route('/shared/<token>/files/<int:index>')
+@read_only_db
+def shared_file(token, index):
+    """A file of a shared note: index 0 of an image/file note, or the gallery/zip member with that ordinal."""
+    share, note = shared_note_or_404(token)
+    if note.content_type in ['image', 'file'] and note.status == 'ready' and index == 0:
+        path, md5_digest, filename = note.content_data, note.md5, note.raw_content
+    elif note.content_type in ['gallery', 'zip']:
+        members = note_members(note) if note.item_count is None else note.items.filter_by(ordinal=index).all()
+        member = next((item for item in members if item.ordinal == index), None)
+        if member is None:
+            raise NotFound()
+        path, md5_digest, filename = member.path, member.md5, member.filename
+    else:
+        raise NotFound()
+    # 图片直接显示，其他文件以附件下载
+    inline = os.path.splitext(path)[1].lower() in THUMBNAIL_SOURCE_EXTENSIONS
+    return send_stored_file(path, etag=md5_digest, download_name=None if inline else filename or os.path.basename(path),
+                            public_max_age=share.max_age())
+
+
 @app.route('/uploads/<path:filename>')
 @login_required
+@read_only_db
 def uploaded_file(filename):
     if '..' in filename or filename.startswith('/'):
         return jsonify({'error': '非法访问'}), 400
+    # blob 按内容共享存储，知道 MD5 不等于有权读取：必须有自己的笔记引用这个文件
+    if not user_owns_file(current_user.id, filename):
+        return jsonify({'error': '无权访问'}), 403
 
-    # This check is important but can be slow. For simplicity, we trust the secure_filename
-    # A more robust check might be needed in a high-security environment.
-    # note = Note.query.filter(Note.content_data.like(f'%{secure_filename(filename)}%'), Note.user_id == current_user.id).first()
-    # if not note:
-    #     return jsonify({'error': '无权访问'}), 403
+    if not os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+        return jsonify({'error': '文件不存在'}), 404
+    # blob 的文件名就是内容的 MD5，URL 对应的内容永远不会变
+    if filename.startswith(f'{BLOB_SUBDIR}/'):
+        return send_stored_file(filename, etag=os.path.splitext(os.path.basename(filename))[0], immutable=True)
+    return send_stored_file(filename)
+
+
+@app.route('/thumbs/<size>/<path:filename>')
+@login_required
+@read_only_db
+def thumbnail(size, filename):
+    """Downscaled copy of a stored image, rendered on first request if the upload job has not made it yet."""
+    if '..' in filename or filename.startswith('/'):
+        return jsonify({'error': '非法访问'}), 400
+    if not user_owns_file(current_user.id, filename):
+        return jsonify({'error': '无权访问'}), 403
+    if size not in app.config['THUMBNAIL_SIZES'] \
+            or os.path.splitext(filename)[1].lower() not in THUMBNAIL_SOURCE_EXTENSIONS:
+        return jsonify({'error': '不支持的缩略图'}), 404
+    if not os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+        return jsonify({'error': '文件不存在'}), 404
+    try:
+        ensure_thumbnails(filename)
+    except Exception as e:
+        logger.warning(f"Thumbnail generation failed for {filename}: {str(e)}")
+        return redirect(url_for('uploaded_file', filename=filename))
 
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_stored_file(thumbnail_relpath(filename, size), immutable=True)
 
 
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+    start_background_workers()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
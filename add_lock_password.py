@@ -1,7 +1,6 @@
-from Gtest import app, db
+from Gtest import app
+from migrate_db import upgrade
 
 with app.app_context():
-    # 删除所有表并重建
-    db.drop_all()
-    db.create_all()
-    print("✅ 数据库已重建！")
\ No newline at end of file
+    # 锁密码字段由迁移 001 添加；不再删表重建，已有数据保持不变
+    upgrade()
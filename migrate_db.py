@@ -1,60 +1,224 @@
-from Gtest import app, db
-from sqlalchemy import text
-
-with app.app_context():
-    # 添加新字段到 note 表
-    try:
-        with db.engine.connect() as conn:
-            # 添加 is_locked
-            conn.execute(text('ALTER TABLE note ADD COLUMN is_locked BOOLEAN DEFAULT 0'))
-            conn.commit()
-            print("✅ 添加 is_locked 字段成功")
-    except Exception as e:
-        print(f"is_locked 字段可能已存在: {e}")
-
-    try:
-        with db.engine.connect() as conn:
-            # 添加 lock_password_hash
-            conn.execute(text('ALTER TABLE note ADD COLUMN lock_password_hash VARCHAR(255)'))
-            conn.commit()
-            print("✅ 添加 lock_password_hash 字段成功")
-    except Exception as e:
-        print(f"lock_password_hash 字段可能已存在: {e}")
-
-    try:
-        with db.engine.connect() as conn:
-            # 添加 encrypted_content
-            conn.execute(text('ALTER TABLE note ADD COLUMN encrypted_content TEXT'))
-            conn.commit()
-            print("✅ 添加 encrypted_content 字段成功")
-    except Exception as e:
-        print(f"encrypted_content 字段可能已存在: {e}")
-
-    try:
-        with db.engine.connect() as conn:
-            # 添加 client_timezone
-            conn.execute(text('ALTER TABLE note ADD COLUMN client_timezone VARCHAR(50)'))
-            conn.commit()
-            print("✅ 添加 client_timezone 字段成功")
-    except Exception as e:
-        print(f"client_timezone 字段可能已存在: {e}")
-
-    try:
-        with db.engine.connect() as conn:
-            # 为 md5 添加索引
-            conn.execute(text('CREATE INDEX IF NOT EXISTS ix_note_md5 ON note (md5)'))
-            conn.commit()
-            print("✅ 添加 md5 索引成功")
-    except Exception as e:
-        print(f"md5 索引可能已存在: {e}")
-
-    # 创建 note_share 表
-    try:
-        db.create_all()
-        print("✅ 创建 note_share 表成功")
-    except Exception as e:
-        print(f"note_share 表可能已存在: {e}")
+"""
+数据库迁移：按版本号依次执行，已执行的版本记录在 schema_migration 表。
+    python migrate_db.py          执行所有未执行的迁移
+    python migrate_db.py status   查看当前版本和待执行的迁移
+数据回填按批提交并记录进度，中断后重跑会从上次的位置继续；每一步之后按耗时暂停，给在线写入让路。
+"""
+import hashlib
+import os
+import sys
 
+from Gtest import app, db, User, Note, NoteItem, Blob, store_blob, acquire_blob, legacy_note_items, index_note, \
+    reconcile_user_usage, SEARCH_INDEX_DDL
+from utils.schema_migrations import MigrationRegistry, MigrationRunner
+
+BATCH_SIZE = 200
+THROTTLE = 1.0  # 每批之后暂停该批耗时的 1 倍
+
+# 数据回填只读写用到的列：Note 模型映射的后续迁移才加的列（如 version）此时在库里还不存在，
+# 整行加载或刷新 Note 实例都会失败；写入用 query.update()，也不会触发 bump_note_version
+
+migrations = MigrationRegistry()
+
+
+def file_md5(path):
+    md5_hash = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            md5_hash.update(block)
+    return md5_hash.hexdigest()
+
+
+@migrations.register(1, '笔记锁定与时区字段')
+def add_lock_columns(ctx):
+    ctx.add_column('note', 'is_locked', 'BOOLEAN DEFAULT 0')
+    ctx.add_column('note', 'lock_password_hash', 'VARCHAR(255)')
+    ctx.add_column('note', 'encrypted_content', 'TEXT')
+    ctx.add_column('note', 'client_timezone', 'VARCHAR(50)')
+
+
+@migrations.register(2, 'md5 索引')
+def add_md5_index(ctx):
+    ctx.create_index('ix_note_md5', 'note', 'md5')
+
+
+@migrations.register(3, '笔记处理状态')
+def add_status_column(ctx):
+    # 后台处理完成前笔记为 pending
+    ctx.add_column('note', 'status', "VARCHAR(20) NOT NULL DEFAULT 'ready'")
+
+
+@migrations.register(4, '画廊/zip 成员数')
+def add_item_count_column(ctx):
+    # 画廊/zip 成员移入 note_item 表后的缓存数量
+    ctx.add_column('note', 'item_count', 'INTEGER')
+
+
+@migrations.register(5, 'MD5 前缀搜索索引')
+def add_md5_prefix_indexes(ctx):
+    # 笔记按 (user_id, md5)，画廊/zip 成员按 md5
+    ctx.create_index('ix_note_user_md5', 'note', 'user_id, md5')
+    ctx.create_index('ix_note_item_md5', 'note_item', 'md5')
+
+
+@migrations.register(6, '笔记列表分页索引')
+def add_timestamp_index(ctx):
+    # 笔记列表按 (timestamp, id) 游标分页
+    ctx.create_index('ix_note_user_timestamp', 'note', 'user_id, timestamp DESC, id DESC')
+
+
+def move_to_blob(path, md5_digest=None):
+    """把旧的平铺文件移入内容寻址存储，返回新的相对路径；文件不存在时返回 None"""
+    if path.startswith('blobs/'):
+        return path
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], path)
+    if not os.path.isfile(file_path):
+        return None
+    md5_digest = md5_digest or file_md5(file_path)
+    blob = store_blob(file_path, md5_digest, os.path.getsize(file_path), path)
+    acquire_blob(blob.md5)
+    return blob.path
+
+
+@migrations.register(7, '旧文件移入内容寻址存储')
+def move_files_to_blobs(ctx):
+    # 成员仍以 JSON 存在 content_data 的画廊/zip 由 008 在记下原文件名之后再移入
+    def batch(after, batch_size):
+        notes = db.session.query(Note.id, Note.content_type, Note.content_data, Note.md5, Note.item_count) \
+            .filter(Note.id > after, Note.content_type.in_(['image', 'file', 'gallery', 'zip'])) \
+            .order_by(Note.id).limit(batch_size).all()
+        if not notes:
+            return None
+        for note in notes:
+            if note.content_type in ['image', 'file']:
+                new_path = move_to_blob(note.content_data, note.md5)
+                if new_path:
+                    Note.query.filter_by(id=note.id).update({'content_data': new_path}, synchronize_session=False)
+            elif note.item_count is not None:
+                for item in NoteItem.query.filter_by(note_id=note.id):
+                    item.path = move_to_blob(item.path, item.md5) or item.path
+            # store_blob 会提交事务，每条笔记的引用与路径更新一起落盘
+            db.session.commit()
+        return notes[-1].id
+
+    ctx.backfill('note', batch)
+    print(f"  📦 当前共有 {Blob.query.count()} 个唯一文件")
+
+
+@migrations.register(8, '画廊/zip 成员移入 note_item 表')
+def move_members_to_note_items(ctx):
+    # 旧版 zip 成员的原文件名只保存在路径里：先从原路径记下 filename，再把文件移入内容寻址存储
+    def batch(after, batch_size):
+        notes = db.session.query(Note.id, Note.content_type, Note.content_data, Note.raw_content) \
+            .filter(Note.id > after, Note.content_type.in_(['gallery', 'zip']), Note.item_count.is_(None)) \
+            .order_by(Note.id).limit(batch_size).all()
+        if not notes:
+            return None
+        for note in notes:
+            items = legacy_note_items(note)
+            blob_md5s = {blob.path: blob.md5 for blob in Blob.query.filter(Blob.path.in_([i.path for i in items]))}
+            for item in items:
+                file_path = os.path.join(app.config['UPLOAD_FOLDER'], item.path)
+                if os.path.isfile(file_path):
+                    item.file_size = os.path.getsize(file_path)
+                    item.md5 = blob_md5s.get(item.path) or file_md5(file_path)
+                    item.path = move_to_blob(item.path, item.md5) or item.path
+            # store_blob 每存一个文件提交一次，成员记录等文件都移完再一起加入
+            db.session.add_all(items)
+            values = {'item_count': len(items), 'content_data': ''}
+            if note.content_type == 'gallery':
+                values['raw_content'] = None  # 原始文件名已写入 note_item.filename
+            Note.query.filter_by(id=note.id).update(values, synchronize_session=False)
+            db.session.commit()
+        return notes[-1].id
+
+    ctx.backfill('note', batch)
+
+
+def index_notes_batch(after, batch_size):
+    """全文索引回填的一批，009 与 013 共用"""
+    notes = db.session.query(Note.id, Note.user_id, Note.content_type, Note.content_data, Note.raw_content,
+                             Note.additional_text, Note.item_count) \
+        .filter(Note.id > after).order_by(Note.id).limit(batch_size).all()
+    if not notes:
+        return None
+    for note in notes:
+        index_note(note)
+    db.session.commit()
+    return notes[-1].id
+
+
+@migrations.register(9, '全文搜索索引')
+def build_search_index(ctx):
+    # 全文索引是 FTS5 虚拟表，create_all 只会为新库创建，这里按现有笔记补齐
+    ctx.execute(SEARCH_INDEX_DDL)
+    ctx.backfill('note', index_notes_batch)
+
+
+@migrations.register(10, '用户用量计数')
+def fill_usage_counters(ctx):
+    def batch(after, batch_size):
+        user_ids = [user_id for (user_id,) in db.session.query(User.id).filter(User.id > after)
+                    .order_by(User.id).limit(batch_size)]
+        if not user_ids:
+            return None
+        for user_id in user_ids:
+            reconcile_user_usage(user_id)
+        db.session.commit()
+        return user_ids[-1]
+
+    ctx.backfill('user', batch)
+
+
+@migrations.register(11, '用户笔记保留期')
+def add_retention_column(ctx):
+    ctx.add_column('user', 'retention_days', 'INTEGER')
+
+
+@migrations.register(12, '笔记版本号')
+def add_note_version_column(ctx):
+    # 分享页缓存按笔记版本区分，内容变化时版本号加一
+    ctx.add_column('note', 'version', 'INTEGER NOT NULL DEFAULT 1')
+
+
+@migrations.register(13, '全文索引按用户过滤')
+def partition_search_index(ctx):
+    # 旧索引的 user_id 列不参与 MATCH，会先对所有用户的命中打分再过滤；重建为带 owner 列的索引
+    if 'owner' not in ctx.columns('note_fts'):
+        # 先记下进度再删表，重建中途中断时重跑会接着补齐
+        ctx.runner.save_checkpoints(ctx.migration.version, {'note': 0})
+        ctx.execute('DROP TABLE IF EXISTS note_fts')
+        ctx.execute(SEARCH_INDEX_DDL)
+    if ctx.runner.load_checkpoints(ctx.migration.version):
+        ctx.backfill('note', index_notes_batch)
+
+
+@migrations.register(14, 'blob 最近使用时间')
+def add_blob_last_seen_column(ctx):
+    # 已有记录留空，存储回收按 created_at 计算
+    ctx.add_column('blob', 'last_seen', 'DATETIME')
+
+
+def upgrade():
+    # 新表（以及新库的全部表和索引）由 create_all 创建，已有表的变更由迁移完成
+    db.create_all()
+    runner = MigrationRunner(db.engine, migrations, batch_size=BATCH_SIZE, throttle=THROTTLE)
+    applied = runner.upgrade()
     print("\n" + "=" * 50)
-    print("✅ 数据库迁移完成！")
-    print("=" * 50)
\ No newline at end of file
+    print(f"✅ 数据库迁移完成！执行了 {len(applied)} 个迁移，当前版本 {runner.current_version()}")
+    print("=" * 50)
+
+
+def status():
+    runner = MigrationRunner(db.engine, migrations)
+    print(f"当前版本: {runner.current_version()}")
+    for migration in runner.pending():
+        print(f"待执行: {migration.version:03d} {migration.name}")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        if sys.argv[1:] == ['status']:
+            status()
+        else:
+            upgrade()
@@ -13,7 +13,7 @@ from datetime import datetime, timezone, timedelta
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from Gtest import app, db, User, Note, Advertisement
+from Gtest import app, db, User, Note
 from werkzeug.security import generate_password_hash
 
 
@@ -27,6 +27,7 @@ class SmokeTestCase(unittest.TestCase):
         """每个测试前的准备"""
         app.config['TESTING'] = True
         app.config['WTF_CSRF_ENABLED'] = False
+        app.config['AUTH_RATE_LIMIT_ENABLED'] = False
         self.client = app.test_client()
 
         # 创建或获取测试账号
@@ -54,10 +55,15 @@ class SmokeTestCase(unittest.TestCase):
 
     def _cleanup_test_data(self):
         """清理测试账号的所有数据（但保留账号）"""
+        from Gtest import delete_user_notes, queue_file_purge, reconcile_user_usage
         user = User.query.filter_by(username=self.TEST_USERNAME).first()
         if user:
-            # 删除该用户的所有笔记
-            Note.query.filter_by(user_id=user.id).delete()
+            # 删除该用户的所有笔记（连同成员、搜索索引、分享和文件引用）
+            note_ids = [note_id for (note_id,) in db.session.query(Note.id).filter_by(user_id=user.id)]
+            _, released_blobs, legacy_paths = delete_user_notes(user.id, note_ids)
+            queue_file_purge(user.id, released_blobs, legacy_paths)
+            # 部分测试直接插入笔记，不经过计数器，这里按实际数据校正
+            reconcile_user_usage(user.id)
             db.session.commit()
 
             # 重置用户为初始状态（非会员）
@@ -98,6 +104,44 @@ class TestAuthentication(SmokeTestCase):
         self.assertEqual(response.status_code, 200)
         print("✅ 登出测试通过")
 
+    def test_03_login_rate_limit(self):
+        """测试同一用户名登录尝试过多时返回 429"""
+        import Gtest
+        from utils.admission import RateLimiter
+        limiter = Gtest.auth_username_limiter
+        Gtest.auth_username_limiter = RateLimiter(1, 60)
+        app.config['AUTH_RATE_LIMIT_ENABLED'] = True
+        try:
+            self.client.post('/login', data={'username': self.TEST_USERNAME, 'password': 'wrong-password'})
+            response = self.client.post('/login', data={'username': self.TEST_USERNAME, 'password': self.TEST_PASSWORD})
+            self.assertEqual(response.status_code, 429)
+            self.assertIn('Retry-After', response.headers)
+        finally:
+            Gtest.auth_username_limiter = limiter
+            app.config['AUTH_RATE_LIMIT_ENABLED'] = False
+        print("✅ 登录限流测试通过")
+
+    def test_04_login_rate_limit_per_forwarded_ip(self):
+        """测试反向代理后按 X-Forwarded-For 的客户端地址分别限流"""
+        import Gtest
+        from utils.admission import RateLimiter
+        limiters = Gtest.auth_ip_limiter, Gtest.auth_username_limiter
+        Gtest.auth_ip_limiter, Gtest.auth_username_limiter = RateLimiter(1, 60), RateLimiter(100, 60)
+        app.wsgi_app.x_for = 1
+        app.config['AUTH_RATE_LIMIT_ENABLED'] = True
+        try:
+            def attempt(ip):
+                return self.client.post('/login', data={'username': self.TEST_USERNAME, 'password': 'wrong-password'},
+                                        headers={'X-Forwarded-For': ip}).status_code
+            self.assertNotEqual(attempt('203.0.113.1'), 429)
+            self.assertEqual(attempt('203.0.113.1'), 429)
+            self.assertNotEqual(attempt('203.0.113.2'), 429)
+        finally:
+            Gtest.auth_ip_limiter, Gtest.auth_username_limiter = limiters
+            app.wsgi_app.x_for = app.config['TRUSTED_PROXY_HOPS']
+            app.config['AUTH_RATE_LIMIT_ENABLED'] = False
+        print("✅ 代理后按客户端 IP 限流测试通过")
+
 
 class TestNoteOperations(SmokeTestCase):
     """测试笔记操作"""
@@ -199,6 +243,588 @@ class TestNoteOperations(SmokeTestCase):
             self.assertIsNone(note)
         print("✅ 删除笔记测试通过")
 
+    def test_05_search_notes(self):
+        """测试全文搜索"""
+        self.login()
+        marker = f'冒烟搜索{os.urandom(4).hex()}'
+        response = self.client.post('/notes/add', json={'type': 'text', 'content': f'前缀 {marker} 后缀'})
+        note_id = response.get_json()['note']['id']
+
+        data = self.client.get(f'/notes/search?q={marker}').get_json()
+        self.assertTrue(data['success'])
+        self.assertEqual([hit['note']['id'] for hit in data['results']], [note_id])
+        self.assertIn(f'<mark>{marker}</mark>', data['results'][0]['snippet'])
+        with app.app_context():
+            from Gtest import search_owner
+            user = User.query.filter_by(username=self.TEST_USERNAME).first()
+            owner = db.session.execute(db.text("SELECT owner FROM note_fts WHERE rowid = :id"), {'id': note_id}).scalar()
+            self.assertEqual(owner, search_owner(user.id))
+
+        self.client.post(f'/notes/edit/{note_id}', json={'content': '已修改的内容'})
+        data = self.client.get(f'/notes/search?q={marker}').get_json()
+        self.assertEqual(data['results'], [])
+        print("✅ 全文搜索测试通过")
+
+    def test_06_cursor_pagination(self):
+        """测试笔记列表游标分页"""
+        self.login()
+        for i in range(3):
+            self.client.post('/notes/add', json={'type': 'text', 'content': f'分页笔记{i}'})
+
+        first = self.client.get('/api/notes?limit=2').get_json()
+        self.assertTrue(first['success'])
+        self.assertEqual(len(first['notes']), 2)
+        self.assertIsNone(first['prev_cursor'])
+        second = self.client.get(f"/api/notes?limit=2&cursor={first['next_cursor']}").get_json()
+        self.assertNotIn(second['notes'][0]['id'], [note['id'] for note in first['notes']])
+        back = self.client.get(f"/api/notes?limit=2&cursor={second['prev_cursor']}").get_json()
+        self.assertEqual([note['id'] for note in back['notes']], [note['id'] for note in first['notes']])
+        self.assertEqual(self.client.get('/api/notes?cursor=invalid').status_code, 400)
+        print("✅ 游标分页测试通过")
+
+    def test_07_usage_counters(self):
+        """测试用户用量计数器随笔记增删同步"""
+        from Gtest import UserUsage, measure_usage
+
+        def note_count():
+            with app.app_context():
+                user = User.query.filter_by(username=self.TEST_USERNAME).first()
+                usage = db.session.get(UserUsage, user.id)
+                self.assertEqual((usage.note_count, usage.storage_bytes), measure_usage(user.id))
+                return usage.note_count
+
+        self.login()
+        before = note_count()
+        note_id = self.client.post('/notes/add', json={'type': 'text', 'content': '计数'}).get_json()['note']['id']
+        self.assertEqual(note_count(), before + 1)
+        self.client.post(f'/notes/delete/{note_id}')
+        self.assertEqual(note_count(), before)
+        print("✅ 用量计数测试通过")
+
+    def test_08_list_preview(self):
+        """测试列表只返回正文预览，全文单独获取"""
+        from Gtest import NOTE_PREVIEW_CHARS
+        self.login()
+        content = '预览' * NOTE_PREVIEW_CHARS
+        note_id = self.client.post('/notes/add', json={'type': 'text', 'content': content}).get_json()['note']['id']
+
+        notes = self.client.get('/api/notes').get_json()['notes']
+        card = next(note for note in notes if note['id'] == note_id)
+        self.assertTrue(card['content_truncated'])
+        self.assertEqual(len(card['content']), NOTE_PREVIEW_CHARS)
+        full = self.client.get(f'/notes/{note_id}').get_json()['note']
+        self.assertEqual(full['content'], content)
+        print("✅ 列表预览测试通过")
+
+    def test_09_bulk_delete(self):
+        """测试批量删除笔记"""
+        self.login()
+        note_ids = [self.client.post('/notes/add', json={'type': 'text', 'content': f'批量 {i}'}).get_json()['note']['id']
+                    for i in range(3)]
+
+        response = self.client.post('/notes/bulk', json={'action': 'delete', 'ids': note_ids[:2]})
+        self.assertEqual(response.get_json(), {'success': True, 'deleted': 2, 'has_more': False})
+        self.assertEqual(self.client.get(f'/notes/{note_ids[0]}').status_code, 404)
+
+        response = self.client.post('/notes/bulk', json={'action': 'delete', 'filter': {'type': 'text'}})
+        self.assertGreaterEqual(response.get_json()['deleted'], 1)
+        self.assertEqual(self.client.get(f'/notes/{note_ids[2]}').status_code, 404)
+
+        self.assertEqual(self.client.post('/notes/bulk', json={'action': 'delete', 'filter': {}}).status_code, 400)
+        self.assertEqual(self.client.post('/notes/bulk', json={'action': 'tag', 'ids': note_ids}).status_code, 400)
+        print("✅ 批量删除测试通过")
+
+    def test_10_retention(self):
+        """测试删除超过保留期的笔记"""
+        from Gtest import enforce_retention
+        with app.app_context():
+            user = User.query.filter_by(username=self.TEST_USERNAME).first()
+            user.retention_days = 30
+            expired = Note(user_id=user.id, content_type='text', content_data='过期的笔记',
+                           timestamp=datetime.now(timezone.utc) - timedelta(days=31))
+            recent = Note(user_id=user.id, content_type='text', content_data='保留期内的笔记')
+            db.session.add_all([expired, recent])
+            db.session.commit()
+            expired_id, recent_id = expired.id, recent.id
+
+            self.assertGreaterEqual(enforce_retention(throttle=0), 1)
+            self.assertIsNone(db.session.get(Note, expired_id))
+            self.assertIsNotNone(db.session.get(Note, recent_id))
+        print("✅ 保留期清理测试通过")
+
+    def test_11_share_link(self):
+        """测试分享链接的访问计数与撤销"""
+        from Gtest import NoteShare, flush_share_views
+        self.login()
+        note_id = self.client.post('/notes/add', json={'type': 'text', 'content': '分享的笔记'}).get_json()['note']['id']
+        data = self.client.post(f'/notes/share/{note_id}', json={'days': 1}).get_json()
+        self.assertTrue(data['success'])
+        shared_path = '/shared/' + data['share_url'].rsplit('/', 1)[1]
+
+        self.logout()
+        for _ in range(3):
+            response = self.client.get(shared_path)
+            self.assertEqual(response.status_code, 200)
+        self.assertIn('分享的笔记', response.get_data(as_text=True))
+        with app.app_context():
+            flush_share_views()
+            self.assertEqual(db.session.get(NoteShare, data['share_id']).access_count, 3)
+
+        self.login()
+        self.assertTrue(self.client.post(f"/notes/share/{data['share_id']}/revoke").get_json()['success'])
+        self.assertEqual(self.client.get(shared_path).status_code, 404)
+        print("✅ 分享链接测试通过")
+
+    def test_12_shared_page_cache(self):
+        """测试分享页的缓存头和编辑后的失效"""
+        self.login()
+        note_id = self.client.post('/notes/add', json={'type': 'text', 'content': '第一版'}).get_json()['note']['id']
+        data = self.client.post(f'/notes/share/{note_id}', json={'days': 1}).get_json()
+        shared_path = '/shared/' + data['share_url'].rsplit('/', 1)[1]
+
+        response = self.client.get(shared_path)
+        self.assertIn('public', response.headers['Cache-Control'])
+        # 已登录的访问者也不能让共享缓存按会话区分
+        self.assertNotIn('Cookie', response.headers.get('Vary', ''))
+        self.assertNotIn('Set-Cookie', response.headers)
+        etag = response.headers['ETag']
+        self.assertEqual(self.client.get(shared_path, headers={'If-None-Match': etag}).status_code, 304)
+
+        self.client.post(f'/notes/edit/{note_id}', json={'content': '第二版'})
+        response = self.client.get(shared_path, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn('第二版', response.get_data(as_text=True))
+        print("✅ 分享页缓存测试通过")
+
+
+class TestChunkUpload(SmokeTestCase):
+    """测试分片上传"""
+
+    def _upload(self, data, chunk_size, chunk_id, order=None):
+        total_chunks = (len(data) + chunk_size - 1) // chunk_size
+        response = None
+        for i in (order or range(total_chunks)):
+            response = self.client.post('/notes/upload_chunk', data={
+                'chunk': (BytesIO(data[i * chunk_size:(i + 1) * chunk_size]), 'smoke.txt'),
+                'filename': 'smoke.txt',
+                'chunkIndex': i,
+                'totalChunks': total_chunks,
+                'chunkSize': chunk_size,
+                'fileSize': len(data),
+                'chunkId': chunk_id
+            }, content_type='multipart/form-data')
+        return response
+
+    def test_01_assemble_in_place(self):
+        """测试分片直接写入目标文件并计算MD5"""
+        import hashlib
+        self.login()
+        data = os.urandom(25 * 1024)
+
+        response = self._upload(data, 10 * 1024, 'smoke-upload-1')
+        self.assertEqual(response.status_code, 200)
+        note = response.get_json()['note']
+        self.assertEqual(note['md5'], hashlib.md5(data).hexdigest())
+        self.assertEqual(note['file_size'], len(data))
+        self.assertFalse(os.path.exists(os.path.join(app.config['TEMP_CHUNK_DIR'], 'smoke-upload-1.part')))
+        print("✅ 分片原位合并测试通过")
+
+    def test_02_upload_status_for_resume(self):
+        """测试查询已上传分片以便续传"""
+        self.login()
+        data = os.urandom(25 * 1024)
+
+        self._upload(data, 10 * 1024, 'smoke-upload-2', order=[0, 2])
+        status = self.client.get('/notes/upload_status/smoke-upload-2').get_json()
+        self.assertEqual(status['received'], [0, 2])
+        self.assertEqual(status['bytes_received'], 15 * 1024)
+
+        response = self._upload(data, 10 * 1024, 'smoke-upload-2', order=[1])
+        self.assertTrue(response.get_json()['success'])
+        self.assertIn('note', response.get_json())
+        print("✅ 分片续传测试通过")
+
+    def test_03_upload_check_before_transfer(self):
+        """测试秒传握手：未知内容需上传，已有内容直接返回"""
+        import hashlib
+        self.login()
+        data = os.urandom(25 * 1024)
+        payload = {'filename': 'smoke.txt', 'file_size': len(data), 'md5': hashlib.md5(data).hexdigest()}
+
+        result = self.client.post('/notes/upload_check', json=payload).get_json()
+        self.assertEqual(result['status'], 'upload')
+
+        self._upload(data, 10 * 1024, 'smoke-upload-3')
+        response = self.client.post('/notes/upload_check', json=payload)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()['status'], 'exists')
+        print("✅ 秒传握手测试通过")
+
+    def test_04_negotiated_out_of_order_upload(self):
+        """测试服务器下发分片大小后乱序上传"""
+        import hashlib
+        self.login()
+        data = os.urandom(12 * 1024 * 1024)
+
+        session = self.client.post('/notes/upload_init', json={
+            'chunk_id': 'smoke-upload-4', 'filename': 'smoke.txt', 'file_size': len(data)
+        }).get_json()
+        self.assertTrue(session['success'])
+        self.assertGreaterEqual(session['max_concurrency'], 1)
+        chunk_size = session['chunk_size']
+
+        response = None
+        for i in reversed(range(session['total_chunks'])):
+            response = self.client.post('/notes/upload_chunk', data={
+                'chunk': (BytesIO(data[i * chunk_size:(i + 1) * chunk_size]), 'smoke.txt'),
+                'chunkIndex': i,
+                'chunkId': 'smoke-upload-4'
+            }, content_type='multipart/form-data')
+        self.assertEqual(response.get_json()['note']['md5'], hashlib.md5(data).hexdigest())
+        print("✅ 乱序分片上传测试通过")
+
+    def test_05_streaming_upload(self):
+        """测试请求体直接上传（不经过 base64）"""
+        import hashlib
+        self.login()
+        data = b'smoke-stream-' + os.urandom(64 * 1024)
+
+        response = self.client.post('/notes/upload_file?filename=smoke.txt&additional_text=stream',
+                                    data=data, content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 200)
+        note = response.get_json()['note']
+        self.assertEqual(note['md5'], hashlib.md5(data).hexdigest())
+        self.assertEqual(note['file_size'], len(data))
+
+        response = self.client.post('/notes/upload_file', data={
+            'file': (BytesIO(data), 'smoke.txt')
+        }, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 409)
+        print("✅ 流式上传测试通过")
+
+    def test_06_upload_job_status(self):
+        """测试上传后台任务的状态查询"""
+        self.login()
+        data = b'smoke-job-' + os.urandom(32 * 1024)
+
+        result = self.client.post('/notes/upload_file?filename=smoke.txt', data=data,
+                                  content_type='application/octet-stream').get_json()
+        self.assertTrue(result['success'])
+        self.assertIn('job_id', result)
+
+        response = self.client.get(f"/notes/jobs/{result['job_id']}")
+        self.assertEqual(response.status_code, 200)
+        job = response.get_json()
+        self.assertIn(job['status'], ['pending', 'running', 'done'])
+        self.assertEqual(job['note']['id'], result['note']['id'])
+        print("✅ 后台任务状态测试通过")
+
+    def test_07_image_thumbnails(self):
+        """测试图片缩略图"""
+        from PIL import Image
+        self.login()
+        buffer = BytesIO()
+        Image.new('RGB', (1600, 1200), (os.urandom(1)[0], 80, 160)).save(buffer, 'PNG')
+
+        result = self.client.post('/notes/upload_file?filename=smoke.png', data=buffer.getvalue(),
+                                  content_type='image/png').get_json()
+        self.assertTrue(result['success'])
+        thumbnails = result['note']['thumbnails']
+        self.assertIn('sm', thumbnails)
+
+        response = self.client.get(thumbnails['sm'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertLessEqual(max(Image.open(BytesIO(response.data)).size), 320)
+        print("✅ 缩略图测试通过")
+
+    def test_08_streaming_gallery_download(self):
+        """测试画廊一键下载（流式ZIP）"""
+        import zipfile
+        from PIL import Image
+        self.login()
+        buffer = BytesIO()
+        Image.new('RGB', (64, 64), (os.urandom(1)[0], 10, 10)).save(buffer, 'PNG')
+        data = buffer.getvalue()
+
+        self.client.post('/notes/upload_init', json={
+            'chunk_id': 'smoke-gallery-8', 'filename': 'smoke.png', 'file_size': len(data), 'mode': 'gallery'
+        })
+        item = self.client.post('/notes/upload_chunk', data={
+            'chunk': (BytesIO(data), 'smoke.png'), 'chunkIndex': 0, 'chunkId': 'smoke-gallery-8'
+        }, content_type='multipart/form-data').get_json()
+        note = self.client.post('/notes/add_multiple', json={'mode': 'gallery', 'file_data': [item]}).get_json()['note']
+
+        response = self.client.get(f"/notes/download_gallery/{note['id']}")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        archive = zipfile.ZipFile(BytesIO(response.data))
+        self.assertEqual(archive.read('smoke.png'), data)
+        self.assertEqual(archive.getinfo('smoke.png').compress_type, zipfile.ZIP_STORED)
+        print("✅ 流式ZIP下载测试通过")
+
+    def test_09_conditional_and_range_download(self):
+        """测试下载的 ETag/304 与断点续传"""
+        self.login()
+        data = b'smoke-range-' + os.urandom(64 * 1024)
+        note = self.client.post('/notes/upload_file?filename=smoke.mp4', data=data,
+                                content_type='video/mp4').get_json()['note']
+
+        response = self.client.get(f"/notes/download/{note['id']}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], f'"{note["md5"]}"')
+
+        response = self.client.get(f"/notes/download/{note['id']}", headers={'If-None-Match': f'"{note["md5"]}"'})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(note['content'], headers={'Range': 'bytes=100-199'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, data[100:200])
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        print("✅ 条件请求与范围请求测试通过")
+
+    def test_10_gallery_items_pagination(self):
+        """测试画廊成员分页接口"""
+        from PIL import Image
+        self.login()
+        file_data = []
+        for i in range(3):
+            buffer = BytesIO()
+            Image.new('RGB', (32, 32 + i), (os.urandom(1)[0], i, 0)).save(buffer, 'PNG')
+            data = buffer.getvalue()
+            self.client.post('/notes/upload_init', json={
+                'chunk_id': f'smoke-gallery-10-{i}', 'filename': f'smoke{i}.png', 'file_size': len(data), 'mode': 'gallery'
+            })
+            file_data.append(self.client.post('/notes/upload_chunk', data={
+                'chunk': (BytesIO(data), f'smoke{i}.png'), 'chunkIndex': 0, 'chunkId': f'smoke-gallery-10-{i}'
+            }, content_type='multipart/form-data').get_json())
+        note = self.client.post('/notes/add_multiple', json={'mode': 'gallery', 'file_data': file_data}).get_json()['note']
+        self.assertEqual(note['item_count'], 3)
+
+        page = self.client.get(f"/notes/gallery/{note['id']}/items?limit=2").get_json()
+        self.assertEqual([item['filename'] for item in page['items']], ['smoke0.png', 'smoke1.png'])
+        page = self.client.get(f"/notes/gallery/{note['id']}/items?cursor={page['next_cursor']}&limit=2").get_json()
+        self.assertEqual([item['filename'] for item in page['items']], ['smoke2.png'])
+        self.assertIsNone(page['next_cursor'])
+        print("✅ 画廊分页测试通过")
+
+    def test_11_md5_prefix_search(self):
+        """测试按 MD5 前缀搜索画廊成员"""
+        import hashlib
+        from PIL import Image
+        self.login()
+        buffer = BytesIO()
+        Image.new('RGB', (24, 24), tuple(os.urandom(3))).save(buffer, 'PNG')
+        data = buffer.getvalue()
+        digest = hashlib.md5(data).hexdigest()
+        self.client.post('/notes/upload_init', json={
+            'chunk_id': 'smoke-md5-11', 'filename': 'smoke.png', 'file_size': len(data), 'mode': 'gallery'
+        })
+        file_data = self.client.post('/notes/upload_chunk', data={
+            'chunk': (BytesIO(data), 'smoke.png'), 'chunkIndex': 0, 'chunkId': 'smoke-md5-11'
+        }, content_type='multipart/form-data').get_json()
+        note = self.client.post('/notes/add_multiple', json={'mode': 'gallery', 'file_data': [file_data]}).get_json()['note']
+
+        data = self.client.get(f'/notes/search?q={digest[:10].upper()}&mode=md5').get_json()
+        self.assertEqual(data['mode'], 'md5')
+        self.assertIn(note['id'], [hit['note']['id'] for hit in data['results']])
+        self.assertFalse(data['truncated'])
+        self.assertEqual(self.client.get('/notes/search?q=abc&mode=md5').status_code, 400)
+
+        import Gtest
+        max_hits = Gtest.MD5_SEARCH_MAX_HITS
+        Gtest.MD5_SEARCH_MAX_HITS = 0
+        try:
+            data = self.client.get(f'/notes/search?q={digest[:10]}&mode=md5').get_json()
+            self.assertTrue(data['truncated'])
+        finally:
+            Gtest.MD5_SEARCH_MAX_HITS = max_hits
+        print("✅ MD5 前缀搜索测试通过")
+
+    def test_12_storage_gc(self):
+        """测试存储回收清理放弃的画廊上传"""
+        import hashlib
+        from collections import Counter
+        from PIL import Image
+        from Gtest import Blob, gc_blob_shard
+        self.login()
+        buffer = BytesIO()
+        Image.new('RGB', (24, 24), tuple(os.urandom(3))).save(buffer, 'PNG')
+        data = buffer.getvalue()
+        digest = hashlib.md5(data).hexdigest()
+        self.client.post('/notes/upload_init', json={
+            'chunk_id': 'smoke-gc-12', 'filename': 'smoke.png', 'file_size': len(data), 'mode': 'gallery'
+        })
+        file_data = self.client.post('/notes/upload_chunk', data={
+            'chunk': (BytesIO(data), 'smoke.png'), 'chunkIndex': 0, 'chunkId': 'smoke-gc-12'
+        }, content_type='multipart/form-data').get_json()
+        # 上传后没有创建画廊笔记：文件无人引用，把它改成宽限期之前上传的
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_data['content'])
+        old = datetime.now(timezone.utc) - app.config['STORAGE_GC_GRACE'] - timedelta(hours=1)
+        os.utime(file_path, (old.timestamp(), old.timestamp()))
+
+        with app.app_context():
+            Blob.query.filter_by(md5=digest).update({'created_at': old, 'last_seen': old})
+            db.session.commit()
+            report = Counter()
+            gc_blob_shard(digest[:2], datetime.now(timezone.utc) - app.config['STORAGE_GC_GRACE'], report)
+            self.assertIsNone(db.session.get(Blob, digest))
+        self.assertGreaterEqual(report['bytes'], len(data))
+        self.assertFalse(os.path.exists(file_path))
+        print("✅ 存储回收测试通过")
+
+    def test_13_upload_job_after_note_deleted(self):
+        """测试笔记删除后上传任务不会作用到复用同一 id 的笔记"""
+        import Gtest
+        from Gtest import Job, run_job
+        self.login()
+        Gtest.background_workers_started = True  # 不内联执行，任务留在队列里
+        try:
+            result = self.client.post('/notes/upload_file?filename=smoke.txt', data=os.urandom(4096),
+                                      content_type='application/octet-stream').get_json()
+        finally:
+            Gtest.background_workers_started = False
+        self.client.post(f"/notes/delete/{result['note']['id']}")
+        other = self.client.post('/notes/add', json={'type': 'text', 'content': '复用id'}).get_json()['note']
+
+        self.assertEqual(self.client.get(f"/notes/jobs/{result['job_id']}").status_code, 404)
+        with app.app_context():
+            self.assertIsNone(db.session.get(Job, result['job_id']).note_id)
+            run_job(result['job_id'])
+            note = db.session.get(Note, other['id'])
+            self.assertEqual((note.content_type, note.content_data), ('text', '复用id'))
+        print("✅ 删除笔记后的上传任务测试通过")
+
+    def test_14_file_access_requires_owner(self):
+        """测试只能读取自己笔记引用的文件"""
+        from PIL import Image
+        self.login()
+        buffer = BytesIO()
+        Image.new('RGB', (32, 32), tuple(os.urandom(3))).save(buffer, 'PNG')
+        note = self.client.post('/notes/upload_file?filename=smoke.png', data=buffer.getvalue(),
+                                content_type='image/png').get_json()['note']
+        self.assertEqual(self.client.get(note['content']).status_code, 200)
+
+        other_client = self._other_user_client()
+        self.assertEqual(other_client.get(note['content']).status_code, 403)
+        self.assertEqual(other_client.get(note['thumbnails']['sm']).status_code, 403)
+        print("✅ 文件访问权限测试通过")
+
+    def test_15_instant_upload_proof_bound_to_user(self):
+        """测试秒传证明绑定用户和挑战令牌，不能被其他用户重放"""
+        import hashlib
+        self.login()
+        data = os.urandom(25 * 1024)
+        self._upload(data, 10 * 1024, 'smoke-upload-15')
+        payload = {'filename': 'smoke.txt', 'file_size': len(data), 'md5': hashlib.md5(data).hexdigest(),
+                   'mode': 'gallery'}
+
+        challenge = self.client.post('/notes/upload_check', json=payload).get_json()
+        self.assertEqual(challenge['status'], 'challenge')
+        proof = dict(payload, proof=hashlib.md5(data[challenge['offset']:challenge['offset'] + challenge['length']])
+                     .hexdigest(), challenge_token=challenge['challenge_token'])
+
+        other_client = self._other_user_client()
+        self.assertEqual(other_client.post('/notes/upload_check', json=proof).get_json()['status'], 'upload')
+        self.assertEqual(self.client.post('/notes/upload_check', json=dict(proof, challenge_token='x'))
+                         .get_json()['status'], 'upload')
+        self.assertEqual(self.client.post('/notes/upload_check', json=proof).get_json()['status'], 'stored')
+        print("✅ 秒传证明绑定测试通过")
+
+    def test_16_reused_chunk_id_ignores_stale_assembly(self):
+        """测试同一 chunk_id 重新上传时不复用其他进程遗留的旧会话缓存"""
+        import hashlib
+        from Gtest import upload_sessions, upload_session_key
+        self.login()
+        with app.app_context():
+            session_key = upload_session_key(User.query.filter_by(username=self.TEST_USERNAME).first().id,
+                                             'smoke-upload-16')
+        first, second = os.urandom(25 * 1024), os.urandom(25 * 1024)
+        self._upload(first, 10 * 1024, 'smoke-upload-16', order=[0, 1])
+        stale = upload_sessions.get(session_key)
+        self.assertEqual(self._upload(first, 10 * 1024, 'smoke-upload-16', order=[2]).get_json()['note']['md5'],
+                         hashlib.md5(first).hexdigest())
+
+        # 模拟另一个进程仍缓存着已完成的旧会话
+        upload_sessions.set(session_key, stale)
+        response = self._upload(second, 10 * 1024, 'smoke-upload-16')
+        self.assertEqual(response.get_json()['note']['md5'], hashlib.md5(second).hexdigest())
+        print("✅ 重用 chunk_id 上传测试通过")
+
+    def test_17_storage_gc_keeps_reused_blob(self):
+        """测试存储回收不会删除刚被上传复用的 blob"""
+        import hashlib
+        from collections import Counter
+        from Gtest import Blob, gc_blob_shard
+        self.login()
+        data = b'smoke-gc-reuse-' + os.urandom(4096)
+        digest = hashlib.md5(data).hexdigest()
+
+        def upload(chunk_id):
+            self.client.post('/notes/upload_init', json={
+                'chunk_id': chunk_id, 'filename': 'smoke.txt', 'file_size': len(data), 'mode': 'gallery'
+            })
+            return self.client.post('/notes/upload_chunk', data={
+                'chunk': (BytesIO(data), 'smoke.txt'), 'chunkIndex': 0, 'chunkId': chunk_id
+            }, content_type='multipart/form-data').get_json()
+
+        file_data = upload('smoke-gc-17a')
+        old = datetime.now(timezone.utc) - app.config['STORAGE_GC_GRACE'] - timedelta(hours=1)
+        with app.app_context():
+            Blob.query.filter_by(md5=digest).update({'created_at': old, 'last_seen': old})
+            db.session.commit()
+        # 同样的内容再次上传，随后在画廊建立前执行回收
+        upload('smoke-gc-17b')
+        with app.app_context():
+            gc_blob_shard(digest[:2], datetime.now(timezone.utc) - app.config['STORAGE_GC_GRACE'], Counter())
+            self.assertIsNotNone(db.session.get(Blob, digest))
+        result = self.client.post('/notes/add_multiple', json={'mode': 'gallery', 'file_data': [file_data]}).get_json()
+        self.assertTrue(result['success'])
+        print("✅ 存储回收保留复用 blob 测试通过")
+
+    def test_18_zip_download_keeps_member_names(self):
+        """测试 ZIP 笔记下载使用成员的原文件名"""
+        import zipfile
+        from Gtest import NoteItem
+        self.login()
+        relpath = f'smoke-zip-{os.urandom(4).hex()}.txt'
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], relpath), 'wb') as f:
+            f.write(b'zip member')
+        with app.app_context():
+            user = User.query.filter_by(username=self.TEST_USERNAME).first()
+            note = Note(user_id=user.id, content_type='zip', content_data='', raw_content='smoke.zip', item_count=1)
+            db.session.add(note)
+            db.session.flush()
+            db.session.add(NoteItem(note_id=note.id, ordinal=0, path=relpath, filename='原始名称.txt'))
+            db.session.commit()
+            note_id = note.id
+
+        response = self.client.get(f'/notes/download_zip/{note_id}')
+        self.assertEqual(zipfile.ZipFile(BytesIO(response.data)).namelist(), ['原始名称.txt'])
+        print("✅ ZIP 成员文件名测试通过")
+
+    def _other_user_client(self):
+        """登录一个临时的第二账号，测试结束后删除"""
+        with app.app_context():
+            db.session.add(User(username='test123_other',
+                                password_hash=generate_password_hash(self.TEST_PASSWORD, method='pbkdf2:sha256')))
+            db.session.commit()
+
+        def remove_user():
+            with app.app_context():
+                user = User.query.filter_by(username='test123_other').first()
+                from Gtest import delete_user_notes, queue_file_purge, UserUsage
+                note_ids = [note_id for (note_id,) in db.session.query(Note.id).filter_by(user_id=user.id)]
+                queue_file_purge(user.id, *delete_user_notes(user.id, note_ids)[1:])
+                UserUsage.query.filter_by(user_id=user.id).delete()
+                db.session.delete(user)
+                db.session.commit()
+        self.addCleanup(remove_user)
+        client = app.test_client()
+        client.post('/login', data={'username': 'test123_other', 'password': self.TEST_PASSWORD})
+        return client
+
 
 class TestUserFeatures(SmokeTestCase):
     """测试用户功能"""
@@ -221,6 +847,34 @@ class TestUserFeatures(SmokeTestCase):
             self.assertEqual(user.username, self.TEST_USERNAME)
             print(f"✅ 用户信息正确: {user.username}")
 
+    def test_03_sqlite_engine_profile(self):
+        """测试 SQLite 连接启用 WAL 且读连接只读"""
+        from sqlalchemy import text
+        from Gtest import get_read_engine
+        with app.app_context():
+            self.assertEqual(db.session.execute(text('PRAGMA journal_mode')).scalar(), 'wal')
+            read_engine = get_read_engine()
+            if read_engine is not None:
+                with read_engine.connect() as conn:
+                    self.assertEqual(conn.execute(text('PRAGMA query_only')).scalar(), 1)
+        print("✅ SQLite 连接配置测试通过")
+
+    def test_04_user_cache(self):
+        """测试登录用户缓存命中与失效"""
+        from Gtest import user_cache
+        self.login()
+        self.client.get('/api/notes')
+        hits = user_cache.stats()['hits']
+        self.client.get('/api/notes')
+        self.assertEqual(user_cache.stats()['hits'], hits + 1)
+        with app.app_context():
+            user = User.query.filter_by(username=self.TEST_USERNAME).first()
+            user_id = user.id
+            user.password_hash = generate_password_hash(self.TEST_PASSWORD, method='pbkdf2:sha256')
+            db.session.commit()
+        self.assertIsNone(user_cache.get(user_id))
+        print("✅ 用户缓存测试通过")
+
 
 class TestBasicFlow(SmokeTestCase):
     """测试基本流程"""
@@ -290,6 +944,7 @@ def run_smoke_tests():
     # 添加测试
     suite.addTests(loader.loadTestsFromTestCase(TestAuthentication))
     suite.addTests(loader.loadTestsFromTestCase(TestNoteOperations))
+    suite.addTests(loader.loadTestsFromTestCase(TestChunkUpload))
     suite.addTests(loader.loadTestsFromTestCase(TestUserFeatures))
     suite.addTests(loader.loadTestsFromTestCase(TestBasicFlow))
 
@@ -0,0 +1,61 @@
+# utils/admission.py
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ExecutorBusy(Exception):
+    """The executor already has as much work in flight as it is allowed to queue."""
+
+
+class BoundedExecutor:
+    """
+    Thread pool that refuses work instead of queueing it without bound: at most
+    `workers` tasks run and `queue_size` more wait; beyond that submit() raises ExecutorBusy.
+    """
+
+    def __init__(self, workers, queue_size, name='bounded'):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def submit(self, fn, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            raise ExecutorBusy()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+class RateLimiter:
+    """Token bucket per key: `rate` attempts per `per` seconds, refilled continuously."""
+
+    def __init__(self, rate, per, max_keys=100000, clock=time.monotonic):
+        self.rate = rate
+        self.per = per
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key):
+        """Take one token for key. Returns 0 when admitted, otherwise the seconds until the next token."""
+        with self._lock:
+            now = self.clock()
+            tokens, last = self._buckets.get(key, (self.rate, now))
+            tokens = min(self.rate, tokens + (now - last) * self.rate / self.per)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                if len(self._buckets) > self.max_keys:
+                    self._prune(now)
+                return 0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) * self.per / self.rate
+
+    def _prune(self, now):
+        """Forget keys whose bucket has refilled; they behave exactly like unseen keys."""
+        self._buckets = {key: (tokens, last) for key, (tokens, last) in self._buckets.items()
+                         if tokens + (now - last) * self.rate / self.per < self.rate}
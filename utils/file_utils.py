@@ -15,4 +15,24 @@ def delete_file(filepath):
     if os.path.exists(filepath):
         os.remove(filepath)
         return True
-    return False
\ No newline at end of file
+    return False
+
+def stream_to_file(stream, filepath, max_size=None, buffer_size=1024 * 1024):
+    """Copy a stream to disk in fixed-size blocks while hashing; returns (size, md5 hexdigest)."""
+    md5_hash = hashlib.md5()
+    size = 0
+    with open(filepath, 'wb') as f:
+        while True:
+            block = stream.read(buffer_size)
+            if not block:
+                break
+            size += len(block)
+            if max_size is not None and size > max_size:
+                raise ValueError(f'file exceeds {max_size} bytes')
+            md5_hash.update(block)
+            f.write(block)
+    return size, md5_hash.hexdigest()
+
+def read_header(filepath, size=2048):
+    with open(filepath, 'rb') as f:
+        return f.read(size)
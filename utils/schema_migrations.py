@@ -0,0 +1,171 @@
+# utils/schema_migrations.py
+import json
+import time
+from datetime import datetime, timezone
+from sqlalchemy import text
+
+VERSION_TABLE = 'schema_migration'
+
+
+class Migration:
+    def __init__(self, version, name, upgrade):
+        self.version = version
+        self.name = name
+        self.upgrade = upgrade
+
+
+class MigrationRegistry:
+    """Ordered list of migrations; register with `@registry.register(version, name)`."""
+
+    def __init__(self):
+        self.migrations = {}
+
+    def register(self, version, name):
+        def decorator(upgrade):
+            if version in self.migrations:
+                raise ValueError(f'duplicate migration version {version}')
+            self.migrations[version] = Migration(version, name, upgrade)
+            return upgrade
+        return decorator
+
+    def __iter__(self):
+        return iter(sorted(self.migrations.values(), key=lambda migration: migration.version))
+
+
+class MigrationContext:
+    """
+    Helpers handed to each migration. Every statement and every backfill batch commits on its
+    own, so a migration never holds the write lock for longer than one step.
+    """
+
+    def __init__(self, runner, migration):
+        self.runner = runner
+        self.engine = runner.engine
+        self.migration = migration
+
+    def execute(self, sql, **params):
+        with self.engine.begin() as conn:
+            return conn.execute(text(sql), params)
+
+    def columns(self, table):
+        with self.engine.connect() as conn:
+            return {row[1] for row in conn.execute(text(f'PRAGMA table_info({table})'))}
+
+    def index_exists(self, name):
+        with self.engine.connect() as conn:
+            return conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name"),
+                                {'name': name}).first() is not None
+
+    def add_column(self, table, column, ddl):
+        """ALTER TABLE ... ADD COLUMN unless the column is already there (e.g. created by create_all)."""
+        if column in self.columns(table):
+            return False
+        self.execute(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}')
+        self.runner.log(f"  + {table}.{column}")
+        return True
+
+    def create_index(self, name, table, columns, unique=False):
+        """
+        Build one index in its own transaction, then pause in proportion to how long the build
+        held the write lock so queued writers get through before the next step.
+        """
+        if self.index_exists(name):
+            return False
+        started = time.monotonic()
+        self.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+        elapsed = time.monotonic() - started
+        self.runner.log(f"  + 索引 {name}（{elapsed:.1f}s）")
+        self.runner.throttle(elapsed)
+        return True
+
+    def backfill(self, name, batch, batch_size=None):
+        """
+        Call batch(after, batch_size) until it returns None. Each call handles the rows after key
+        `after`, commits, and returns the last key it handled. The key is checkpointed after every
+        batch, so an interrupted run resumes where it stopped; batches must be safe to repeat.
+        """
+        batch_size = batch_size or self.runner.batch_size
+        checkpoints = self.runner.load_checkpoints(self.migration.version)
+        after = checkpoints.get(name, 0)
+        batches = 0
+        while True:
+            started = time.monotonic()
+            last = batch(after, batch_size)
+            if last is None:
+                break
+            after = checkpoints[name] = last
+            self.runner.save_checkpoints(self.migration.version, checkpoints)
+            batches += 1
+            if batches % 20 == 0:
+                self.runner.log(f"  … {name} 已处理到 #{after}")
+            self.runner.throttle(time.monotonic() - started)
+        return after
+
+
+class MigrationRunner:
+    """
+    Applies registered migrations in version order and records each one in schema_migration.
+    throttle is the pause after each step as a fraction of the step's duration
+    (1.0 keeps migrations to roughly half of the database's write time).
+    """
+
+    def __init__(self, engine, registry, batch_size=500, throttle=1.0, max_pause=5.0, log=print):
+        self.engine = engine
+        self.registry = registry
+        self.batch_size = batch_size
+        self.throttle_ratio = throttle
+        self.max_pause = max_pause
+        self.log = log
+
+    def ensure_version_table(self):
+        with self.engine.begin() as conn:
+            conn.execute(text(f'CREATE TABLE IF NOT EXISTS {VERSION_TABLE} ('
+                              'version INTEGER PRIMARY KEY, name VARCHAR(200) NOT NULL, checkpoint TEXT, '
+                              'started_at DATETIME, applied_at DATETIME)'))
+
+    def applied_versions(self):
+        self.ensure_version_table()
+        with self.engine.connect() as conn:
+            return {row[0] for row in conn.execute(
+                text(f'SELECT version FROM {VERSION_TABLE} WHERE applied_at IS NOT NULL'))}
+
+    def current_version(self):
+        return max(self.applied_versions(), default=0)
+
+    def pending(self):
+        applied = self.applied_versions()
+        return [migration for migration in self.registry if migration.version not in applied]
+
+    def throttle(self, elapsed):
+        if self.throttle_ratio > 0:
+            time.sleep(min(elapsed * self.throttle_ratio, self.max_pause))
+
+    def load_checkpoints(self, version):
+        with self.engine.connect() as conn:
+            raw = conn.execute(text(f'SELECT checkpoint FROM {VERSION_TABLE} WHERE version = :version'),
+                               {'version': version}).scalar()
+        return json.loads(raw) if raw else {}
+
+    def save_checkpoints(self, version, checkpoints):
+        with self.engine.begin() as conn:
+            conn.execute(text(f'UPDATE {VERSION_TABLE} SET checkpoint = :checkpoint WHERE version = :version'),
+                         {'checkpoint': json.dumps(checkpoints), 'version': version})
+
+    def upgrade(self, target=None):
+        """Apply pending migrations up to target (all when None); returns the versions applied."""
+        applied = []
+        for migration in self.pending():
+            if target is not None and migration.version > target:
+                break
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            with self.engine.begin() as conn:
+                conn.execute(text(f'INSERT OR IGNORE INTO {VERSION_TABLE} (version, name, started_at) '
+                                  'VALUES (:version, :name, :now)'),
+                             {'version': migration.version, 'name': migration.name, 'now': now})
+            self.log(f"→ {migration.version:03d} {migration.name}")
+            migration.upgrade(MigrationContext(self, migration))
+            with self.engine.begin() as conn:
+                conn.execute(text(f'UPDATE {VERSION_TABLE} SET applied_at = :now WHERE version = :version'),
+                             {'now': datetime.now(timezone.utc).replace(tzinfo=None), 'version': migration.version})
+            applied.append(migration.version)
+        return applied
@@ -0,0 +1,35 @@
+# utils/thumbnails.py
+import os
+import threading
+from PIL import Image, ImageOps
+
+
+def render_thumbnails(src_path, targets, image_format='webp', quality=80):
+    """
+    Render downscaled copies of an image.
+    `targets` maps destination path -> longest edge in pixels. The image is decoded once
+    (JPEG at a reduced scale via draft mode) and each size is scaled from the previous,
+    larger one. Files are written to a temp name and renamed, so readers never see a partial
+    thumbnail and concurrent renders of the same image are harmless.
+    """
+    ordered = sorted(targets.items(), key=lambda item: item[1], reverse=True)
+    largest = ordered[0][1]
+    save_format = 'JPEG' if image_format.lower() in ('jpg', 'jpeg') else image_format.upper()
+    with Image.open(src_path) as img:
+        img.draft('RGB', (largest, largest))
+        img = ImageOps.exif_transpose(img)
+        if save_format == 'JPEG':
+            img = img.convert('RGB')
+        elif img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        for dest_path, edge in ordered:
+            img = img.copy()
+            img.thumbnail((edge, edge), Image.LANCZOS)
+            tmp_path = f'{dest_path}.{os.getpid()}-{threading.get_ident()}.tmp'
+            try:
+                img.save(tmp_path, format=save_format, quality=quality)
+                os.replace(tmp_path, dest_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    return len(ordered)
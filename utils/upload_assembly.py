@@ -0,0 +1,117 @@
+# utils/upload_assembly.py
+import hashlib
+import threading
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class ChunkAssembly:
+    """
+    Assembles a chunked upload in place.
+    - The target file is preallocated to its final size on the first chunk.
+    - Each chunk is written straight to its offset, no per-chunk temp files.
+    - The MD5 is rolled forward over the contiguous prefix of received chunks,
+      so finishing the upload only has to read the digest.
+    """
+
+    def __init__(self, part_path, file_size, chunk_size, total_chunks):
+        self.part_path = part_path
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.total_chunks = total_chunks
+        self.received = set()
+        self.hashed_chunks = 0
+        self._md5 = hashlib.md5()
+        self._inline_busy = False
+        self.lock = threading.Lock()
+
+    def preallocate(self):
+        with open(self.part_path, 'wb') as f:
+            f.truncate(self.file_size)
+
+    def expected_length(self, index):
+        if index == self.total_chunks - 1:
+            return self.file_size - index * self.chunk_size
+        return self.chunk_size
+
+    def write_chunk(self, index, stream):
+        """
+        Copy one chunk from `stream` to its final position. Returns the number of bytes written.
+        Chunks for different offsets may be written concurrently; only bookkeeping takes the lock.
+        """
+        if index < 0 or index >= self.total_chunks:
+            raise ValueError(f'chunk index {index} out of range')
+        expected = self.expected_length(index)
+        with self.lock:
+            # 正好是摘要的下一个分片时边写边算，其他线程此时不会推进摘要
+            hash_inline = index == self.hashed_chunks and index not in self.received and not self._inline_busy
+            if hash_inline:
+                self._inline_busy = True
+        written = 0
+        try:
+            with open(self.part_path, 'r+b') as f:
+                f.seek(index * self.chunk_size)
+                while True:
+                    data = stream.read(min(COPY_BUFFER_SIZE, expected - written + 1))
+                    if not data:
+                        break
+                    written += len(data)
+                    if written > expected:
+                        raise ValueError(f'chunk {index} is larger than {expected} bytes')
+                    f.write(data)
+                    if hash_inline:
+                        self._md5.update(data)
+            if written != expected:
+                raise ValueError(f'chunk {index} has {written} bytes, expected {expected}')
+        except Exception:
+            if hash_inline:
+                with self.lock:
+                    self._inline_busy = False
+                    # 已经写入摘要的数据无法回退，从头重算
+                    self._rehash_prefix()
+            raise
+        with self.lock:
+            self.received.add(index)
+            if hash_inline:
+                self._inline_busy = False
+                self.hashed_chunks += 1
+            self._advance_digest()
+        return written
+
+    def _advance_digest(self):
+        """Fold chunks that landed ahead of the hashed prefix into the digest. Caller holds the lock."""
+        if self._inline_busy or self.hashed_chunks >= self.total_chunks or self.hashed_chunks not in self.received:
+            return
+        with open(self.part_path, 'rb') as f:
+            while self.hashed_chunks in self.received:
+                f.seek(self.hashed_chunks * self.chunk_size)
+                remaining = self.expected_length(self.hashed_chunks)
+                while remaining > 0:
+                    data = f.read(min(COPY_BUFFER_SIZE, remaining))
+                    if not data:
+                        break
+                    self._md5.update(data)
+                    remaining -= len(data)
+                self.hashed_chunks += 1
+
+    def _rehash_prefix(self):
+        self._md5 = hashlib.md5()
+        self.hashed_chunks = 0
+        self._advance_digest()
+
+    def sync_received(self, indices):
+        """Merge chunk indices recorded elsewhere (e.g. by another worker); their bytes are already on disk."""
+        with self.lock:
+            self.received.update(indices)
+
+    def hexdigest(self):
+        with self.lock:
+            self._advance_digest()
+            if self.hashed_chunks == self.total_chunks:
+                return self._md5.hexdigest()
+        # 滚动摘要没能覆盖全部分片（例如同一分片的重试仍在写入），退回到完整读取
+        md5_hash = hashlib.md5()
+        with open(self.part_path, 'rb') as f:
+            for block in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+                md5_hash.update(block)
+        return md5_hash.hexdigest()
@@ -0,0 +1,34 @@
+# utils/view_counter.py
+import threading
+from collections import Counter
+
+
+class CounterBuffer:
+    """
+    Thread-safe counts accumulated in memory between flushes, so a hot key costs one
+    increment per event and one database write per flush instead of a write per event.
+    """
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, key, amount=1):
+        with self._lock:
+            self._counts[key] += amount
+
+    def pending(self, key):
+        """Count added since the last drain, not yet written anywhere."""
+        with self._lock:
+            return self._counts.get(key, 0)
+
+    def drain(self):
+        """Take every pending count, leaving the buffer empty."""
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+        return counts
+
+    def restore(self, counts):
+        """Put drained counts back, e.g. after the flush that took them failed."""
+        with self._lock:
+            self._counts.update(counts)
@@ -0,0 +1,62 @@
+# utils/zip_stream.py
+import os
+import zipfile
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# 这些格式本身已经压缩过，再 deflate 只会浪费 CPU
+COMPRESSED_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.webp',
+    '.zip', '.rar', '.7z',
+    '.mp4', '.mov', '.avi', '.mp3',
+    '.docx', '.xlsx', '.pptx',
+}
+
+
+class _ChunkSink:
+    """
+    Write-only, unseekable file object. ZipFile notices it cannot seek and writes data
+    descriptors after each member instead of patching local headers afterwards.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries, buffer_size=COPY_BUFFER_SIZE):
+    """
+    Yield a ZIP archive of (file_path, arcname) pairs as it is produced.
+    Memory use is bounded by buffer_size whatever the archive size; ZIP64 records are used
+    automatically for large members, and already-compressed media is STORED.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', allowZip64=True) as zip_file:
+        for file_path, arcname in entries:
+            zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+            ext = os.path.splitext(arcname)[1].lower()
+            zinfo.compress_type = zipfile.ZIP_STORED if ext in COMPRESSED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            with open(file_path, 'rb') as src, zip_file.open(zinfo, 'w') as dest:
+                for block in iter(lambda: src.read(buffer_size), b''):
+                    dest.write(block)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    # 关闭时写入中央目录
+    data = sink.drain()
+    if data:
+        yield data